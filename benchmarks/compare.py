@@ -0,0 +1,51 @@
+"""
+Compare two result files of ``benchmarks.transports``::
+
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+KEY = ('transport', 'workers', 'qsize', 'latency', 'events', 'payload',
+       'rate', 'burst')
+
+METRICS = ('events_per_sec', 'latency_p50', 'latency_p99', 'stall_total',
+           'peak_rss')
+
+
+def load(filename):
+    with open(filename) as f:
+        report = json.load(f)
+
+    return {
+        tuple(result[name] for name in KEY): result
+        for result in report['results']
+    }
+
+
+def change(before, after):
+    if not before or after is None:
+        return 'n/a'
+
+    return '{:+.1f}%'.format((after - before) / before * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args(argv)
+
+    before, after = load(args.before), load(args.after)
+
+    for key in sorted(set(before) & set(after), key=str):
+        print('{} workers={} qsize={} latency={}'.format(*key[:4]))
+
+        for metric in METRICS:
+            old, new = before[key][metric], after[key][metric]
+            print('    {:<16} {:>14} {:>14} {:>8}'.format(
+                metric, str(old), str(new), change(old, new)))
+
+
+if __name__ == '__main__':
+    main()
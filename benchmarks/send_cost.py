@@ -0,0 +1,127 @@
+"""
+Per-send CPU cost with and without the cached per-DSN request templates.
+
+Times ``_prepare_request`` against parsing the URL and building the header
+multidict for every send, then sends events one at a time through
+``AioHttpTransport`` to ``tests.fake.FakeServer`` and reports the process
+CPU time per send for both::
+
+    python -m benchmarks.send_cost --number 100000 --events 2000
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import timeit
+import zlib
+
+from multidict import CIMultiDict
+from yarl import URL
+
+from benchmarks.utils import metadata
+from raven_aiohttp import AioHttpTransport
+from tests.fake import FakeResolver, FakeServer
+
+HEADERS = {
+    'User-Agent': 'raven-python/6.0.0',
+    'Content-Type': 'application/octet-stream',
+    'Content-Encoding': 'deflate',
+}
+
+
+def auth_header(timestamp):
+    return ('Sentry sentry_timestamp={}, sentry_client=raven-python/6.0.0, '
+            'sentry_version=6, sentry_key=public, '
+            'sentry_secret=secret'.format(timestamp))
+
+
+class UncachedTransport(AioHttpTransport):
+    """Parses the URL and builds the headers for every send."""
+
+    def _prepare_request(self, url, headers):
+        return url, headers
+
+
+def prepare_cost(number, loop):
+    url = 'https://sentry.example.com/api/1/store/'
+    headers = dict(HEADERS, **{'X-Sentry-Auth': auth_header(time.time())})
+
+    transport = AioHttpTransport(loop=loop)
+
+    def uncached():
+        # what aiohttp does with a str and a dict
+        URL(url)
+        CIMultiDict(headers)
+
+    def cached():
+        transport._prepare_request(url, headers)
+
+    results = {}
+    for name, func in [('uncached', uncached), ('cached', cached)]:
+        elapsed = min(timeit.repeat(func, number=number, repeat=3))
+        results[name + '_ns'] = elapsed / number * 1e9
+
+    loop.run_until_complete(transport.close())
+
+    return results
+
+
+@asyncio.coroutine
+def send_cost(cls, events, loop):
+    server = FakeServer(loop=loop)
+    yield from server.start()
+
+    url = 'http://127.0.0.1:{}/api/1/store/'.format(server.port)
+    data = zlib.compress(json.dumps({'message': 'benchmark'}).encode('utf-8'))
+
+    transport = cls(loop=loop, resolver=FakeResolver(server.port))
+
+    @asyncio.coroutine
+    def send():
+        done = asyncio.Future(loop=loop)
+        headers = dict(HEADERS, **{'X-Sentry-Auth': auth_header(time.time())})
+
+        transport.async_send(url, data, headers,
+                             lambda: done.set_result(None),
+                             done.set_exception)
+        yield from done
+
+    # the connection is set up outside the measurement
+    yield from send()
+
+    started = time.process_time()
+    for _ in range(events):
+        yield from send()
+    elapsed = time.process_time() - started
+
+    yield from transport.close()
+    yield from server.close()
+
+    return elapsed / events
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--events', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    loop = asyncio.new_event_loop()
+    try:
+        results = {'prepare': prepare_cost(args.number, loop)}
+
+        for name, cls in [('uncached', UncachedTransport),
+                          ('cached', AioHttpTransport)]:
+            cost = loop.run_until_complete(send_cost(cls, args.events, loop))
+            results[name + '_send_us'] = cost * 1e6
+    finally:
+        loop.close()
+
+    json.dump({'metadata': metadata(), 'results': results}, sys.stdout,
+              indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Startup cost for applications which configure Sentry but rarely send.
+
+Times ``import raven_aiohttp`` in fresh interpreters, the construction of
+every transport and the lazy session creation of the first send::
+
+    python -m benchmarks.startup --imports 20 --number 1000
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+import timeit
+
+from benchmarks.utils import metadata, percentile
+from raven_aiohttp import (AioHttpTransport, BatchedAioHttpTransport,
+                           QueuedAioHttpTransport)
+
+IMPORT = (
+    'import time; started = time.perf_counter(); import raven_aiohttp; '
+    'print(time.perf_counter() - started)'
+)
+
+URL = 'https://sentry.example.com/api/1/store/'
+
+TRANSPORTS = [AioHttpTransport, QueuedAioHttpTransport,
+              BatchedAioHttpTransport]
+
+
+def import_times(number):
+    times = []
+    for _ in range(number):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT])
+        times.append(float(output))
+
+    return times
+
+
+def construction(cls, number, loop):
+    transports = []
+
+    def construct():
+        transports.append(cls(loop=loop))
+
+    elapsed = timeit.timeit(construct, number=number)
+
+    started = time.perf_counter()
+    for transport in transports:
+        transport._get_client_session(URL)
+    session = time.perf_counter() - started
+
+    closes = [transport.close() for transport in transports]
+    loop.run_until_complete(asyncio.gather(*closes, loop=loop))
+
+    return elapsed / number, session / number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--imports', type=int, default=20)
+    parser.add_argument('--number', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    times = sorted(import_times(args.imports))
+
+    results = {
+        'import_p50_ms': percentile(times, 50) * 1e3,
+        'import_p99_ms': percentile(times, 99) * 1e3,
+    }
+
+    loop = asyncio.new_event_loop()
+    try:
+        for cls in TRANSPORTS:
+            construct, session = construction(cls, args.number, loop)
+            results[cls.__name__] = {
+                'construct_us': construct * 1e6,
+                'first_session_us': session * 1e6,
+            }
+    finally:
+        loop.close()
+
+    json.dump({'metadata': metadata(), 'results': results}, sys.stdout,
+              indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
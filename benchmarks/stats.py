@@ -0,0 +1,55 @@
+"""
+Hot path cost of the transport statistics.
+
+Times the counter updates and the latency observation ``_post`` does for
+every request, next to the cost of a bare attribute increment::
+
+    python -m benchmarks.stats --number 1000000
+"""
+import argparse
+import json
+import sys
+import timeit
+
+from raven_aiohttp import TransportStats
+
+
+def per_request(stats):
+    stats.requests += 1
+    stats.in_flight += 1
+    stats.in_flight -= 1
+    stats.succeeded += 1
+    stats.observe_latency(0.042)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=1000000)
+    args = parser.parse_args(argv)
+
+    stats = TransportStats()
+
+    def increment():
+        stats.requests += 1
+
+    def observe():
+        stats.observe_latency(0.042)
+
+    def request():
+        per_request(stats)
+
+    def snapshot():
+        stats.snapshot()
+
+    results = {}
+    for name, func in [('increment', increment), ('observe_latency', observe),
+                       ('per_request', request), ('snapshot', snapshot)]:
+        elapsed = min(timeit.repeat(func, number=args.number, repeat=3))
+        results[name + '_ns'] = elapsed / args.number * 1e9
+
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
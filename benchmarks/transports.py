@@ -0,0 +1,190 @@
+"""
+Throughput and latency of AioHttpTransport and QueuedAioHttpTransport.
+
+Runs every combination of transport, worker count, queue size and server
+latency against ``tests.fake.FakeServer``, each in its own process so the
+peak RSS is not shared between runs, and writes the results as JSON::
+
+    python -m benchmarks.transports --events 5000 --output before.json
+    python -m benchmarks.transports --events 5000 --output after.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import subprocess
+import sys
+import zlib
+
+from benchmarks.utils import StallMonitor, metadata, peak_rss, percentile
+from raven_aiohttp import AioHttpTransport, QueuedAioHttpTransport
+from tests.fake import FakeResolver, FakeServer
+
+TRANSPORTS = {
+    'AioHttpTransport': AioHttpTransport,
+    'QueuedAioHttpTransport': QueuedAioHttpTransport,
+}
+
+
+def make_payload(size):
+    event = {
+        'message': 'benchmark',
+        'level': 'error',
+        'extra': {'padding': 'x' * size},
+    }
+
+    return zlib.compress(json.dumps(event).encode('utf-8'))
+
+
+@asyncio.coroutine
+def run(config, loop):
+    server = FakeServer(loop=loop)
+    server.slop_factor = config['latency']
+    yield from server.start()
+
+    url = 'http://127.0.0.1:{}/api/1/store/'.format(server.port)
+    headers = {'Content-Encoding': 'deflate'}
+    data = make_payload(config['payload'])
+
+    cls = TRANSPORTS[config['transport']]
+    kwargs = {}
+    if cls is QueuedAioHttpTransport:
+        kwargs.update(workers=config['workers'], qsize=config['qsize'])
+
+    transport = cls(loop=loop, resolver=FakeResolver(server.port), **kwargs)
+
+    latencies = []
+    failures = []
+
+    def send():
+        sent = loop.time()
+
+        def success_cb():
+            latencies.append(loop.time() - sent)
+
+        transport.async_send(url, data, headers, success_cb, failures.append)
+
+    monitor = StallMonitor(loop=loop)
+    monitor.start()
+
+    start = loop.time()
+    for i in range(config['events']):
+        send()
+
+        if config['rate']:
+            yield from asyncio.sleep(1 / config['rate'], loop=loop)
+        elif i % config['burst'] == 0:
+            yield from asyncio.sleep(0, loop=loop)
+
+    yield from transport.close()
+    elapsed = loop.time() - start
+
+    yield from monitor.stop()
+    yield from server.close()
+
+    latencies.sort()
+
+    result = dict(config)
+    result.update({
+        'delivered': len(latencies),
+        'failed': len(failures),
+        'elapsed': elapsed,
+        'events_per_sec': len(latencies) / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': latencies[-1] if latencies else None,
+        'stall_total': monitor.total,
+        'stall_max': monitor.max,
+        'peak_rss': peak_rss(),
+    })
+
+    return result
+
+
+def run_single(config):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run(config, loop))
+    finally:
+        loop.close()
+
+
+def configs(args):
+    for name, latency in itertools.product(args.transports, args.latencies):
+        base = {
+            'transport': name,
+            'latency': latency,
+            'events': args.events,
+            'payload': args.payload,
+            'rate': args.rate,
+            'burst': args.burst,
+            'workers': None,
+            'qsize': None,
+        }
+
+        if TRANSPORTS[name] is not QueuedAioHttpTransport:
+            yield base
+            continue
+
+        for workers, qsize in itertools.product(args.workers, args.qsizes):
+            config = dict(base)
+            config.update(workers=workers, qsize=qsize)
+            yield config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--payload', type=int, default=2048,
+                        help='uncompressed padding per event in bytes')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='events per second, 0 sends as fast as possible')
+    parser.add_argument('--burst', type=int, default=100,
+                        help='events sent between yields to the loop')
+    parser.add_argument('--transports', nargs='+', default=sorted(TRANSPORTS),
+                        choices=sorted(TRANSPORTS))
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--qsizes', nargs='+', type=int,
+                        default=[1000, 10000])
+    parser.add_argument('--latencies', nargs='+', type=float,
+                        default=[0, 0.01, 0.05],
+                        help='server side delay per request in seconds')
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        json.dump(run_single(json.loads(args.single)), sys.stdout)
+        return
+
+    results = []
+    for config in configs(args):
+        output = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.transports',
+            '--single', json.dumps(config),
+        ])
+        result = json.loads(output.decode('utf-8'))
+        results.append(result)
+
+        sys.stderr.write(
+            '{transport} workers={workers} qsize={qsize} latency={latency}: '
+            '{events_per_sec:.0f} events/s, '
+            'p99 {latency_p99} s\n'.format(**result))
+
+    report = {'metadata': metadata(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+import math
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+try:
+    from asyncio import ensure_future
+except ImportError:
+    ensure_future = getattr(asyncio, 'async')
+
+
+class StallMonitor:
+    """Measures how late the event loop wakes up a sleeping coroutine.
+
+    Every ``interval`` seconds a probe sleeps and records the time between
+    the expected and the actual wakeup, which is the time the loop spent
+    running other callbacks.
+    """
+
+    def __init__(self, *, interval=0.001, loop):
+        self.interval = interval
+        self.loop = loop
+        self.stalls = []
+        self._task = None
+
+    def start(self):
+        self._task = ensure_future(self._probe(), loop=self.loop)
+
+    @asyncio.coroutine
+    def stop(self):
+        self._task.cancel()
+        try:
+            yield from self._task
+        except asyncio.CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def _probe(self):
+        while True:
+            start = self.loop.time()
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            self.stalls.append(
+                max(0, self.loop.time() - start - self.interval))
+
+    @property
+    def total(self):
+        return sum(self.stalls)
+
+    @property
+    def max(self):
+        return max(self.stalls, default=0)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of already sorted ``values``."""
+    if not values:
+        return None
+
+    index = max(0, int(math.ceil(p / 100 * len(values))) - 1)
+    return values[index]
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return usage
+
+    return usage * 1024
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'aiohttp': aiohttp.__version__,
+        'platform': platform.platform(),
+        'time': time.time(),
+    }
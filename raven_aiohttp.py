@@ -6,20 +6,50 @@ raven_aiohttp
 :license: BSD, see LICENSE for more details.
 """
 import abc
+import argparse
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import signal
 import socket
+import stat
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
 
 import aiohttp
+from aiohttp.abc import AbstractResolver
+from multidict import CIMultiDict
+from raven.base import Client
 from raven.conf import defaults
 from raven.exceptions import APIError, RateLimited
 from raven.transport.base import AsyncTransport
 from raven.transport.http import HTTPTransport
+from raven.utils import json as raven_json
+from yarl import URL
 
 try:
     from asyncio import ensure_future
 except ImportError:
     ensure_future = getattr(asyncio, 'async')
 
+try:
+    from asyncio import _get_running_loop
+except ImportError:  # Python < 3.5.3, the loop records its thread instead
+    _get_running_loop = None
+
 try:
     from raven.transport.base import has_newstyle_transports
 except ImportError:
@@ -28,236 +58,2793 @@ except ImportError:
 __version__ = '0.7.0'
 
 
-class AioHttpTransportBase(
-    AsyncTransport,
-    HTTPTransport,
-    metaclass=abc.ABCMeta
-):
+class RetryPolicy:
+    """Exponential backoff with full jitter for transient send failures.
 
-    def __init__(self, parsed_url=None, *, verify_ssl=True,
-                 timeout=defaults.TIMEOUT,
-                 keepalive=True, family=socket.AF_INET, loop=None):
-        self._keepalive = keepalive
-        self._family = family
-        if loop is None:
-            loop = asyncio.get_event_loop()
+    ``attempts`` counts the first send, ``deadline`` (seconds since the
+    event was handed to the transport) caps the total time spent retrying.
+    """
 
-        self._loop = loop
+    def __init__(self, *, attempts=3, base_delay=0.5, max_delay=30,
+                 deadline=60, statuses=(500, 502, 503, 504),
+                 exceptions=(aiohttp.ClientError, asyncio.TimeoutError)):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.statuses = frozenset(statuses)
+        self.exceptions = tuple(exceptions)
 
-        if has_newstyle_transports:
-            if parsed_url is not None:
-                raise TypeError('Transport accepts no URLs for this version '
-                                'of raven.')
-            super().__init__(timeout, verify_ssl)
+    def is_retryable(self, exc):
+        if isinstance(exc, APIError):
+            return exc.code in self.statuses
+
+        return isinstance(exc, self.exceptions)
+
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+        return random.uniform(0, delay)
+
+
+LEVEL_PRIORITIES = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'fatal': logging.CRITICAL,
+}
+
+
+def event_level_priority(data, headers):
+    """Priority function which ranks messages by the event level.
+
+    The payload has to be decoded for that, so it is opt-in:
+    ``QueuedAioHttpTransport(priority=event_level_priority)``.
+    """
+    if headers.get('Content-Encoding') == 'deflate':
+        data = zlib.decompress(data)
+
+    level = json.loads(data.decode('utf-8')).get('level', logging.ERROR)
+    if isinstance(level, int):
+        return level
+
+    return LEVEL_PRIORITIES.get(level, logging.ERROR)
+
+
+class TokenBucket:
+    """Client side limit of outbound requests.
+
+    Tokens are refilled at ``rate`` per second up to ``burst``. Queued
+    transports wait for a token (``waited`` sums up the time spent),
+    ``AioHttpTransport`` drops sends when the bucket is empty (counted in
+    ``rejected``).
+    """
+
+    def __init__(self, rate, burst=None):
+        if burst is None:
+            burst = max(1, rate)
+
+        self.rate = rate
+        self.burst = burst
+        self.waited = 0.0
+        self.rejected = 0
+
+        self._tokens = burst
+        self._updated = None
+
+    def _refill(self, now):
+        if self._updated is not None:
+            elapsed = now - self._updated
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+
+        self._updated = now
+
+    def try_acquire(self, now):
+        self._refill(now)
+
+        if self._tokens < 1:
+            self.rejected += 1
+            return False
+
+        self._tokens -= 1
+        return True
+
+    def reserve(self, now):
+        """Take a token, returns how long to wait before using it.
+
+        The balance may go negative so that concurrent waiters are served in
+        order.
+        """
+        self._refill(now)
+
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+
+        delay = -self._tokens / self.rate
+        self.waited += delay
+        return delay
+
+
+class CircuitOpen(Exception):
+    """Raised instead of sending while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fails sends fast while Sentry is unreachable.
+
+    Opens after ``failures`` consecutive connection errors, timeouts or 5xx
+    responses. While open sends raise ``CircuitOpen`` (counted in
+    ``rejected``), every ``reset_timeout`` seconds a single send is let
+    through as a probe (``half_open``). Any successful send closes the
+    circuit again. ``on_change(old, new)`` is called for every transition,
+    by default it logs to ``sentry.errors``.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, *, failures=5, reset_timeout=30, on_change=None):
+        if on_change is None:
+            on_change = self._log_change
+
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.rejected = 0
+
+        self._failures = 0
+        self._next_probe = None
+
+    @staticmethod
+    def _log_change(old, new):
+        logging.getLogger('sentry.errors').warning(
+            'Sentry circuit breaker changed from %s to %s', old, new)
+
+    def _set_state(self, state):
+        old, self.state = self.state, state
+
+        if old != state:
+            self.on_change(old, state)
+
+    def allow(self, now):
+        if self.state == self.CLOSED:
+            return True
+
+        if now < self._next_probe:
+            self.rejected += 1
+            return False
+
+        # a probe which hangs or gets cancelled is followed by another one
+        self._next_probe = now + self.reset_timeout
+        self._set_state(self.HALF_OPEN)
+        return True
+
+    def success(self):
+        self._failures = 0
+        self._set_state(self.CLOSED)
+
+    def failure(self, now):
+        self._failures += 1
+
+        if self.state == self.HALF_OPEN or self._failures >= self.failures:
+            self._next_probe = now + self.reset_timeout
+            self._set_state(self.OPEN)
+
+
+# (url, headers, data) records, used by the spool and the relay protocol
+_RECORD = struct.Struct('>II')
+
+
+def _pack_record(url, headers, data):
+    header = json.dumps([url, headers]).encode('utf-8')
+    return b''.join([_RECORD.pack(len(header), len(data)), header, data])
+
+
+class Spool:
+    """Append-only on-disk spool for messages which could not be sent.
+
+    Messages are appended to segment files of about ``segment_size`` bytes
+    in ``path``. When the spool grows beyond ``max_size`` the oldest
+    segments are removed. Files are fsync'ed at most every
+    ``fsync_interval`` seconds (``0`` on every write, ``None`` never).
+
+    Records include the ``X-Sentry-Auth`` header, ``path`` is created
+    readable by the owner only and so are the segments.
+
+    All file operations are blocking, transports run them in ``executor``.
+    """
+
+    SUFFIX = '.spool'
+
+    _RECORD = _RECORD
+
+    def __init__(self, path, *, segment_size=16 * 1024 * 1024,
+                 max_size=256 * 1024 * 1024, fsync_interval=1.0,
+                 chunk_size=64 * 1024):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync_interval = fsync_interval
+        self.chunk_size = chunk_size
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.written = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.replay_failed = 0
+
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+        self._sizes = collections.OrderedDict()
+        for name in sorted(os.listdir(path)):
+            if name.endswith(self.SUFFIX):
+                filename = os.path.join(path, name)
+                self._sizes[filename] = os.path.getsize(filename)
+
+        self.size = sum(self._sizes.values())
+
+        self._file = None
+        self._active = None
+        self._last_fsync = 0
+
+        if self._sizes:
+            last = os.path.basename(next(reversed(self._sizes)))
+            self._next_segment = int(last[:-len(self.SUFFIX)]) + 1
         else:
-            super().__init__(parsed_url, timeout, verify_ssl)
+            self._next_segment = 0
+
+    def _open_segment(self):
+        name = '{:020d}{}'.format(self._next_segment, self.SUFFIX)
+        self._next_segment += 1
+
+        self._active = os.path.join(self.path, name)
+        fd = os.open(self._active, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                     0o600)
+        self._file = os.fdopen(fd, 'ab')
+        self._sizes[self._active] = 0
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+
+        self._file.flush()
+        if self.fsync_interval is not None:
+            os.fsync(self._file.fileno())
+
+        self._file.close()
+        self._file = None
+        self._active = None
+
+    def _remove_oldest(self):
+        for filename in self._sizes:
+            if filename != self._active:
+                self.remove(filename)
+                return True
+
+        return False
+
+    def write(self, records):
+        """Append ``(url, headers, data)`` records."""
+        for url, headers, data in records:
+            record = _pack_record(url, headers, data)
+
+            while self.size + len(record) > self.max_size:
+                if not self._remove_oldest():
+                    break
+
+            if self.size + len(record) > self.max_size:
+                self.dropped += 1
+                continue
+
+            if self._file is None or \
+                    self._sizes[self._active] >= self.segment_size:
+                self._close_segment()
+                self._open_segment()
+
+            self._file.write(record)
+            self._sizes[self._active] += len(record)
+            self.size += len(record)
+            self.written += 1
+
+        if self._file is None:
+            return
+
+        self._file.flush()
+
+        now = time.monotonic()
+        if self.fsync_interval is not None and \
+                now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._file.fileno())
+            self._last_fsync = now
+
+    def seal(self):
+        """Close the active segment, returns all segments oldest first."""
+        self._close_segment()
+
+        return list(self._sizes)
+
+    def read(self, filename, offset):
+        """Read about ``chunk_size`` bytes of records starting at ``offset``.
+
+        Returns a list of ``(end offset, (url, headers, data))``, the list
+        is empty at the end of the segment. A torn record at the end of the
+        file is skipped.
+        """
+        records = []
+        header_size = self._RECORD.size
+
+        try:
+            f = open(filename, 'rb')
+        except FileNotFoundError:
+            return records
+
+        with f:
+            f.seek(offset)
+            buf = f.read(self.chunk_size)
+            pos = 0
+
+            while True:
+                if len(buf) - pos < header_size:
+                    if records:
+                        break
+
+                    buf += f.read(header_size - (len(buf) - pos))
+                    if len(buf) - pos < header_size:
+                        break
+
+                meta_size, data_size = self._RECORD.unpack_from(buf, pos)
+                start = pos + header_size
+                end = start + meta_size + data_size
+
+                if end > len(buf):
+                    if records:
+                        break
+
+                    buf += f.read(end - len(buf))
+                    if end > len(buf):
+                        break
+
+                url, headers = json.loads(
+                    buf[start:start + meta_size].decode('utf-8'))
+                data = buf[start + meta_size:end]
+
+                pos = end
+                records.append((offset + pos, (url, headers, data)))
+
+        return records
+
+    def remove(self, filename):
+        if filename == self._active:
+            self._close_segment()
+
+        size = self._sizes.pop(filename, 0)
+        self.size -= size
+
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        self._close_segment()
+
+
+def event_fingerprint(data, headers):
+    """Fingerprint of an encoded event for burst deduplication.
+
+    Ignores per-event fields like ``event_id`` and ``timestamp`` and uses
+    an explicit ``fingerprint`` if the event has one.
+    """
+    if headers.get('Content-Encoding') == 'deflate':
+        data = zlib.decompress(data)
+
+    event = json.loads(data.decode('utf-8'))
+
+    key = event.get('fingerprint')
+    if key is None:
+        exceptions = (event.get('exception') or {}).get('values') or ()
+        key = [
+            event.get('level'),
+            event.get('logger'),
+            event.get('culprit'),
+            event.get('message'),
+            [
+                (
+                    exc.get('type'),
+                    exc.get('value'),
+                    [
+                        (frame.get('filename'), frame.get('function'),
+                         frame.get('lineno'))
+                        for frame in
+                        (exc.get('stacktrace') or {}).get('frames') or ()
+                    ],
+                )
+                for exc in exceptions
+            ],
+        ]
+
+    key = json.dumps(key, sort_keys=True, default=str).encode('utf-8')
+
+    return hashlib.sha1(key).hexdigest()
+
+
+class Deduplicator:
+    """Forward one representative per fingerprint and ``window`` seconds.
+
+    At most ``maxsize`` fingerprints are remembered, the oldest ones are
+    evicted first. Suppressed duplicates are counted and handed to
+    ``report`` as a ``{fingerprint: count}`` summary once their window is
+    over; by default the summary is logged to ``sentry.errors``.
+    """
+
+    def __init__(self, *, window=60, maxsize=10000,
+                 fingerprint=event_fingerprint, report=None):
+        self.window = window
+        self.maxsize = maxsize
+        self.fingerprint = fingerprint
+        self.report = report if report is not None else self._log_report
+        self.suppressed = 0
+
+        # fingerprint -> [first seen, suppressed count], oldest first
+        self._seen = collections.OrderedDict()
+        self._summary = {}
+
+    def __len__(self):
+        return len(self._seen)
+
+    def forward(self, data, headers, now):
+        self._expire(now)
+
+        key = self.fingerprint(data, headers)
+
+        entry = self._seen.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self.suppressed += 1
+            return False
+
+        if len(self._seen) >= self.maxsize:
+            self._evict(*self._seen.popitem(last=False))
+
+        self._seen[key] = [now, 0]
+        return True
+
+    def purge(self, now, *, everything=False):
+        if everything:
+            while self._seen:
+                self._evict(*self._seen.popitem(last=False))
+        else:
+            self._expire(now)
+
+        summary, self._summary = self._summary, {}
+
+        if summary:
+            self.report(summary)
+
+        return summary
+
+    def _expire(self, now):
+        deadline = now - self.window
+
+        while self._seen:
+            key, entry = next(iter(self._seen.items()))
+            if entry[0] > deadline:
+                break
+
+            del self._seen[key]
+            self._evict(key, entry)
+
+    def _evict(self, key, entry):
+        if entry[1]:
+            self._summary[key] = self._summary.get(key, 0) + entry[1]
+
+    @staticmethod
+    def _log_report(summary):
+        logging.getLogger('sentry.errors').warning(
+            'Suppressed %d duplicate events in %d groups',
+            sum(summary.values()), len(summary))
+
+
+# Sentry rejects larger (compressed) store requests with 413
+MAX_PAYLOAD_SIZE = 1024 * 1024
+
+
+class PayloadTooLarge(Exception):
+    """Passed to the failure callback of events over ``max_payload_size``."""
+
+    def __init__(self, size, limit):
+        super().__init__('Payload of {} bytes exceeds the limit of {} '
+                         'bytes'.format(size, limit))
+        self.size = size
+        self.limit = limit
+
+
+def _event_frames(event):
+    stacktraces = [event.get('stacktrace')]
+    for exc in (event.get('exception') or {}).get('values') or ():
+        stacktraces.append(exc.get('stacktrace'))
+
+    for stacktrace in stacktraces:
+        for frame in (stacktrace or {}).get('frames') or ():
+            yield frame
+
+
+def _trim_frame_keys(*keys):
+    def trim(event):
+        trimmed = False
+        for frame in _event_frames(event):
+            for key in keys:
+                trimmed = frame.pop(key, None) is not None or trimmed
+        return trimmed
+
+    return trim
+
+
+def _trim_breadcrumbs(keep):
+    def trim(event):
+        breadcrumbs = event.get('breadcrumbs') or {}
+        values = breadcrumbs.get('values') or []
+        if len(values) <= keep:
+            return False
+
+        breadcrumbs['values'] = values[len(values) - keep:]
+        return True
+
+    return trim
+
+
+def _trim_request_data(event):
+    return (event.get('request') or {}).pop('data', None) is not None
+
+
+def _trim_extra(event):
+    return event.pop('extra', None) is not None
+
+
+# least useful first, the event is re-encoded after every stage
+TRIM_STAGES = (
+    _trim_frame_keys('vars'),
+    _trim_breadcrumbs(10),
+    _trim_extra,
+    _trim_request_data,
+    _trim_frame_keys('pre_context', 'post_context'),
+    _trim_breadcrumbs(0),
+)
+
+
+def trim_event(data, headers, limit):
+    """Trimmer which shrinks an encoded event below ``limit`` bytes.
+
+    Drops frame locals, all but the last breadcrumbs, ``extra``, the request
+    body, source context and the remaining breadcrumbs, in that order, until
+    the re-encoded event fits. Returns the smallest encoding reached, the
+    transport rejects it if that is still too large:
+    ``AioHttpTransport(trimmer=trim_event)``.
+    """
+    deflate = headers.get('Content-Encoding') == 'deflate'
+
+    payload = zlib.decompress(data) if deflate else data
+    event = json.loads(payload.decode('utf-8'))
+
+    for stage in TRIM_STAGES:
+        if not stage(event):
+            continue
+
+        data = json.dumps(event).encode('utf-8')
+        if deflate:
+            data = zlib.compress(data)
+
+        if len(data) <= limit:
+            break
+
+    return data
+
+
+class TransportStats:
+    """Counters and a fixed-bucket latency histogram of a transport.
+
+    Counters are plain attributes so updating them on the hot path is a
+    single attribute increment. ``gauges`` maps names to callables which
+    are only evaluated by ``snapshot()``.
+    """
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0)
+
+    COUNTERS = ('requests', 'succeeded', 'failed', 'status_4xx',
+                'status_5xx', 'status_429', 'errors', 'retried', 'dropped',
+                'spooled', 'rate_limit_held', 'rate_limit_dropped',
+                'delivered', 'undelivered', 'trimmed', 'oversized')
+
+    def __init__(self, *, buckets=LATENCY_BUCKETS, gauges=None):
+        self.buckets = tuple(buckets)
+        self.gauges = dict(gauges or {})
+
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+
+        self.in_flight = 0
+        self.latency_counts = [0] * (len(self.buckets) + 1)
+        self.latency_sum = 0.0
+
+    def observe_latency(self, value):
+        self.latency_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.latency_sum += value
+
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in self.COUNTERS}
+        snapshot['in_flight'] = self.in_flight
+
+        for name, gauge in self.gauges.items():
+            snapshot[name] = gauge()
+
+        snapshot['latency'] = {
+            'buckets': self.buckets,
+            'counts': list(self.latency_counts),
+            'sum': self.latency_sum,
+        }
+
+        return snapshot
+
+
+class Instrumentation:
+    """Hot-path timing of a transport and an event loop lag monitor.
+
+    Records the time the transport spends on the event loop in
+    ``async_send``, in the success and failure callbacks raven passes in
+    (``callback``) and in the steps of every send between its awaits
+    (``send``): ``totals``, ``counts`` and ``max`` per section.
+
+    Every ``lag_interval`` seconds the monitor checks how late the loop woke
+    it up. Lags of at least ``lag_threshold`` are counted in ``stalls`` and
+    passed to ``on_stall(lag, transport_time)`` together with the time spent
+    in the transport since the previous check, by default they are logged to
+    ``sentry.errors``.
+    """
+
+    SECTIONS = ('async_send', 'callback', 'send')
+
+    def __init__(self, *, lag_interval=0.5, lag_threshold=0.1,
+                 on_stall=None):
+        if on_stall is None:
+            on_stall = self._log_stall
+
+        self.lag_interval = lag_interval
+        self.lag_threshold = lag_threshold
+        self.on_stall = on_stall
+
+        self.totals = dict.fromkeys(self.SECTIONS, 0.0)
+        self.counts = dict.fromkeys(self.SECTIONS, 0)
+        self.max = dict.fromkeys(self.SECTIONS, 0.0)
+        self.stalls = 0
+        self.max_lag = 0.0
+
+        # transport time since the last lag check
+        self._window = 0.0
+        self._loop = None
+        self._handle = None
+
+    @staticmethod
+    def _log_stall(lag, transport_time):
+        logging.getLogger('sentry.errors').warning(
+            'Event loop stalled for %.3fs, the Sentry transport used %.3fs '
+            'since the previous check', lag, transport_time)
+
+    def record(self, section, elapsed):
+        self.totals[section] += elapsed
+        self.counts[section] += 1
+        if elapsed > self.max[section]:
+            self.max[section] = elapsed
+
+        self._window += elapsed
+
+    def start(self, loop):
+        if self._handle is None:
+            self._loop = loop
+            self._schedule()
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _schedule(self):
+        expected = self._loop.time() + self.lag_interval
+        self._handle = self._loop.call_at(expected, self._check, expected)
+
+    def _check(self, expected):
+        lag = self._loop.time() - expected
+        transport_time, self._window = self._window, 0.0
+
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+        if lag >= self.lag_threshold:
+            self.stalls += 1
+            self.on_stall(lag, transport_time)
+
+        self._schedule()
+
+    def timed(self, section, func):
+        """Wrap ``func`` so that every call is recorded in ``section``."""
+        record = self.record
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(section, time.perf_counter() - started)
+
+        return wrapper
+
+    @asyncio.coroutine
+    def timed_steps(self, section, coro):
+        """Run ``coro`` and record the time of its steps between awaits."""
+        send, value = coro.send, None
+        elapsed = 0.0
+
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    future = send(value)
+                except StopIteration as exc:
+                    return exc.value
+                finally:
+                    elapsed += time.perf_counter() - started
+
+                try:
+                    value = yield future
+                except GeneratorExit:
+                    coro.close()
+                    raise
+                except BaseException as exc:
+                    send, value = coro.throw, exc
+                else:
+                    send = coro.send
+        finally:
+            self.record(section, elapsed)
+
+    def snapshot(self):
+        return {
+            'totals': dict(self.totals),
+            'counts': dict(self.counts),
+            'max': dict(self.max),
+            'stalls': self.stalls,
+            'max_lag': self.max_lag,
+        }
+
+
+# the only header raven builds anew for every event
+AUTH_HEADER = 'X-Sentry-Auth'
+
+
+class _RequestTemplate:
+    """Parsed URL and static headers of the requests to one DSN."""
+
+    __slots__ = ('url', 'static', 'headers')
+
+    def __init__(self, url, static):
+        self.url = URL(url)
+        self.static = static
+        self.headers = CIMultiDict(static)
+
+
+class _Message:
+
+    __slots__ = ('url', 'data', 'headers', 'success_cb', 'failure_cb',
+                 'priority', 'created', 'enqueued', 'attempt')
+
+    def __init__(self, url, data, headers, success_cb, failure_cb, *,
+                 priority=0, created):
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.success_cb = success_cb
+        self.failure_cb = failure_cb
+        self.priority = priority
+        self.created = created
+        self.enqueued = created
+        self.attempt = 0
+
+
+class _PriorityBuffer:
+    """Double-ended priority queue of messages.
+
+    ``pop()`` returns the most important message (FIFO within a priority),
+    ``shed()`` removes the least important one (oldest first within a
+    priority). Both heaps share entries which are deleted lazily, a heap is
+    rebuilt once it holds more dead entries than live ones.
+
+    The ``...`` sentinel always comes out last and is never shed.
+    ``nbytes`` sums up the payload sizes of the messages.
+    """
+
+    def __init__(self):
+        self._pop_heap = []
+        self._shed_heap = []
+        self._pop_dead = 0
+        self._shed_dead = 0
+        self._counter = itertools.count()
+        self._size = 0
+        self._sentinels = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return self._size + self._sentinels
+
+    def __iter__(self):
+        for _, _, entry in sorted(self._pop_heap):
+            if entry[1]:
+                yield entry[0]
+
+        for _ in range(self._sentinels):
+            yield ...
+
+    def append(self, message):
+        if message is ...:
+            self._sentinels += 1
+            return
+
+        seq = next(self._counter)
+        entry = [message, True]
+
+        heapq.heappush(self._pop_heap, (-message.priority, seq, entry))
+        heapq.heappush(self._shed_heap, (message.priority, seq, entry))
+        self._size += 1
+        self.nbytes += len(message.data)
+
+    def popleft(self):
+        if not self._size:
+            self._sentinels -= 1
+            return ...
+
+        message = self._take(self._pop_heap)
+        self._shed_dead += 1
+        self._maybe_compact()
+
+        return message
+
+    def up_to(self, priority):
+        """Messages of at most ``priority``, in no particular order."""
+        for _, _, entry in self._shed_heap:
+            if entry[1] and entry[0].priority <= priority:
+                yield entry[0]
+
+    def shed(self):
+        message = self._take(self._shed_heap)
+        self._pop_dead += 1
+        self._maybe_compact()
+
+        return message
+
+    def _take(self, heap):
+        while True:
+            _, _, entry = heapq.heappop(heap)
+
+            if entry[1]:
+                entry[1] = False
+                self._size -= 1
+                self.nbytes -= len(entry[0].data)
+                return entry[0]
+
+            if heap is self._pop_heap:
+                self._pop_dead -= 1
+            else:
+                self._shed_dead -= 1
+
+    def _maybe_compact(self):
+        if self._pop_dead > self._size:
+            self._pop_heap = self._compact(self._pop_heap)
+            self._pop_dead = 0
+
+        if self._shed_dead > self._size:
+            self._shed_heap = self._compact(self._shed_heap)
+            self._shed_dead = 0
+
+    @staticmethod
+    def _compact(heap):
+        heap = [item for item in heap if item[2][1]]
+        heapq.heapify(heap)
+        return heap
+
+
+class _PriorityQueue(asyncio.Queue):
+    """Priority queue limited to ``maxsize`` messages and ``maxbytes``."""
+
+    def __init__(self, maxsize=0, *, maxbytes=None, loop=None):
+        self.maxbytes = maxbytes
+        self._room_waiters = []
+
+        super().__init__(maxsize, loop=loop)
+
+    @property
+    def nbytes(self):
+        return self._queue.nbytes
+
+    def _init(self, maxsize):
+        self._queue = _PriorityBuffer()
+
+    def _put(self, item):
+        self._queue.append(item)
+
+    def _get(self):
+        item = self._queue.popleft()
+        self._wake_room_waiters()
+        return item
+
+    def too_large(self, size):
+        return self.maxbytes is not None and size > self.maxbytes
+
+    def has_room(self, size):
+        if 0 < self.maxsize <= self.qsize():
+            return False
+
+        return self.maxbytes is None or self.nbytes + size <= self.maxbytes
+
+    def can_shed_room(self, size, priority):
+        """Whether shedding messages of at most ``priority`` makes room."""
+        count = 0
+        if self.maxsize > 0:
+            count = self.qsize() - self.maxsize + 1
+
+        nbytes = 0
+        if self.maxbytes is not None:
+            nbytes = self.nbytes + size - self.maxbytes
+
+        for message in self._queue.up_to(priority):
+            if count <= 0 and nbytes <= 0:
+                break
+
+            count -= 1
+            nbytes -= len(message.data)
+
+        return count <= 0 and nbytes <= 0
+
+    def _wake_room_waiters(self):
+        waiters, self._room_waiters = self._room_waiters, []
+
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @asyncio.coroutine
+    def wait_room(self, size):
+        """Wait until a message of ``size`` bytes fits into the queue."""
+        while not self.has_room(size):
+            waiter = asyncio.Future(loop=self._loop)
+            self._room_waiters.append(waiter)
+
+            yield from waiter
+
+    def shed_nowait(self):
+        """Remove and return the least important message.
+
+        Like ``get_nowait()`` the caller has to call ``task_done()``.
+        """
+        if not self._queue._size:
+            raise asyncio.QueueEmpty
+
+        item = self._queue.shed()
+        self._wake_room_waiters()
+        return item
+
+
+class HappyEyeballsResolver(AbstractResolver):
+    """Resolver which races IPv6 and IPv4 to pick the address family.
+
+    Wraps ``resolver`` (``aiohttp.DefaultResolver`` by default). Lookups
+    of both families (``socket.AF_UNSPEC``) start a TCP connection to the
+    first IPv6 address and, ``delay`` seconds later or as soon as that
+    fails, to the first IPv4 address. The family which connects first is
+    returned first by lookups of that host for ``ttl`` seconds, the other
+    one stays as a fallback. Used by transports with ``family=None``.
+    """
+
+    def __init__(self, resolver=None, *, delay=0.25, ttl=600, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        if resolver is None:
+            resolver = aiohttp.DefaultResolver(loop=loop)
+
+        self.delay = delay
+        self.ttl = ttl
+
+        self._resolver = resolver
+        self._loop = loop
+        # (host, port) -> (family, expires)
+        self._winners = {}
+
+    @asyncio.coroutine
+    def resolve(self, host, port=0, family=socket.AF_UNSPEC):
+        hosts = yield from self._resolver.resolve(host, port, family=family)
+        if family != socket.AF_UNSPEC:
+            return hosts
+
+        key = (host, port)
+        winner, expires = self._winners.get(key, (None, 0))
+
+        if expires <= self._loop.time():
+            winner = yield from self._race(hosts)
+            if winner is None:
+                self._winners.pop(key, None)
+                return hosts
+
+            self._winners[key] = (winner, self._loop.time() + self.ttl)
+
+        # stable, the resolver's order within a family is kept
+        return sorted(hosts, key=lambda entry: entry['family'] != winner)
+
+    @asyncio.coroutine
+    def _race(self, hosts):
+        candidates = []
+        for family in (socket.AF_INET6, socket.AF_INET):
+            for entry in hosts:
+                if entry['family'] == family:
+                    candidates.append(entry)
+                    break
+
+        if len(candidates) < 2:
+            return None
+
+        pending = set()
+        try:
+            for index, entry in enumerate(candidates):
+                pending.add(ensure_future(self._connect(entry),
+                                          loop=self._loop))
+                last = index == len(candidates) - 1
+
+                while pending:
+                    done, pending = yield from asyncio.wait(
+                        pending, timeout=None if last else self.delay,
+                        return_when=asyncio.FIRST_COMPLETED, loop=self._loop)
+
+                    for fut in done:
+                        if fut.exception() is None:
+                            return fut.result()
+
+                    if not last:
+                        # the delay expired or the attempt failed early
+                        break
+
+            return None
+        finally:
+            for fut in pending:
+                fut.cancel()
+
+    @asyncio.coroutine
+    def _connect(self, entry):
+        transport, _ = yield from self._loop.create_connection(
+            asyncio.Protocol, entry['host'], entry['port'],
+            family=entry['family'])
+        # a probe only, the connector opens its own connection
+        transport.close()
+
+        return entry['family']
+
+    @asyncio.coroutine
+    def close(self):
+        yield from self._resolver.close()
+
+
+class SessionRegistry:
+    """Shares client sessions and their connection pools between transports.
+
+    Transports given the same registry use one ``aiohttp.ClientSession`` per
+    event loop, Sentry host and process. The session is built with the
+    settings of the first transport and closed once the last transport
+    using it is closed.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def acquire(self, key, factory):
+        try:
+            entry = self._sessions[key]
+        except KeyError:
+            entry = self._sessions[key] = [factory(), 0]
+
+        entry[1] += 1
+        return entry[0]
+
+    @asyncio.coroutine
+    def release(self, key):
+        entry = self._sessions[key]
+        entry[1] -= 1
+
+        if entry[1] == 0:
+            del self._sessions[key]
+            yield from entry[0].close()
+
+
+class AioHttpTransportBase(
+    AsyncTransport,
+    HTTPTransport,
+    metaclass=abc.ABCMeta
+):
+
+    # request templates kept, one per DSN, see _prepare_request()
+    MAX_TEMPLATES = 64
+
+    def __init__(self, parsed_url=None, *, verify_ssl=True,
+                 timeout=defaults.TIMEOUT,
+                 keepalive=True, family=socket.AF_INET, limit=100,
+                 limit_per_host=0, keepalive_timeout=None, ttl_dns_cache=10,
+                 resolver=None, connector_kwargs=None, retry_policy=None,
+                 priority=None, dedup=None, throttle=None,
+                 circuit_breaker=None, spool=None, session_registry=None,
+                 max_payload_size=MAX_PAYLOAD_SIZE, trimmer=None,
+                 instrumentation=None, drop_report=None,
+                 drop_report_interval=10,
+                 stats_callback=None, stats_interval=60, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self._loop = loop
+
+        if family is None:
+            # both families, ordered by HappyEyeballsResolver
+            family = socket.AF_UNSPEC
+            if not isinstance(resolver, HappyEyeballsResolver):
+                resolver = HappyEyeballsResolver(resolver, loop=loop)
+
+        self._keepalive = keepalive
+        self._family = family
+
+        self._connector_kwargs = dict(connector_kwargs or {})
+        self._connector_kwargs.update(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=ttl_dns_cache,
+        )
+        if resolver is not None:
+            self._connector_kwargs['resolver'] = resolver
+        if not keepalive:
+            # one pool for all sends, connections are closed after each one
+            self._connector_kwargs['force_close'] = True
+        elif keepalive_timeout is not None:
+            self._connector_kwargs['keepalive_timeout'] = keepalive_timeout
+
+        if has_newstyle_transports:
+            if parsed_url is not None:
+                raise TypeError('Transport accepts no URLs for this version '
+                                'of raven.')
+            super().__init__(timeout, verify_ssl)
+        else:
+            super().__init__(parsed_url, timeout, verify_ssl)
+
+        # per url, see _prepare_request()
+        self._templates = {}
+
+        # created on the first send, see _get_client_session()
+        self._client_session = None
+        self._client_session_pid = None
+        self._session_registry = session_registry
+        self._session_key = None
+
+        self._closing = False
+
+        # accepted messages without a final outcome yet, see flush()
+        self._outstanding = set()
+        # (limit, future) pairs, see _wait_pending()
+        self._flush_waiters = []
+
+        if drop_report is None:
+            drop_report = self._log_drops
+
+        # dropped messages by reason, reported every drop_report_interval
+        self._drops = collections.Counter()
+        self._drop_report = drop_report
+        self._drop_report_interval = drop_report_interval
+        self._drop_report_handle = None
+
+        # async_send() calls from other threads, drained on the loop
+        self._handoff = collections.deque()
+        self._handoff_scheduled = False
+
+        # without _get_running_loop the loop records its own thread; the
+        # transport may well be created in another one
+        self._loop_thread = None
+        if _get_running_loop is None:
+            self._loop.call_soon_threadsafe(self._set_loop_thread)
+
+        self._rate_limited_until = 0
+        self.stats = TransportStats()
+        self._stats_callback = stats_callback
+        self._stats_interval = stats_interval
+        self._stats_handle = None
+
+        self._retry_policy = retry_policy
+        self._retries = {}
+
+        self._priority = priority
+
+        self._throttle = throttle
+
+        self._circuit_breaker = circuit_breaker
+
+        self._max_payload_size = max_payload_size
+        self._trimmer = trimmer
+
+        self._dedup = dedup
+        self._dedup_handle = None
+        if dedup is not None:
+            self._dedup_handle = self._loop.call_later(
+                dedup.window, self._purge_dedup)
+
+        self._spool = spool
+        self._spool_buffer = []
+        self._spool_writing = None
+        self._spool_replay = None
+        self._spool_offsets = {}
+
+        gauges = self.stats.gauges
+        gauges['pending'] = lambda: self.pending
+        if throttle is not None:
+            gauges['throttle_waited'] = lambda: throttle.waited
+            gauges['throttle_rejected'] = lambda: throttle.rejected
+        if circuit_breaker is not None:
+            gauges['circuit_state'] = lambda: circuit_breaker.state
+            gauges['circuit_rejected'] = lambda: circuit_breaker.rejected
+        if dedup is not None:
+            gauges['dedup_suppressed'] = lambda: dedup.suppressed
+        if spool is not None:
+            gauges['spool_size'] = lambda: spool.size
+
+        self._instrumentation = instrumentation
+        if instrumentation is not None:
+            gauges['loop_stalls'] = lambda: instrumentation.stalls
+            gauges['loop_lag_max'] = lambda: instrumentation.max_lag
+            self._instrument(instrumentation)
+
+        if stats_callback is not None:
+            self._stats_handle = self._loop.call_later(
+                stats_interval, self._export_stats)
+
+    def _instrument(self, instrumentation):
+        # instance attributes shadow the methods, so transports without
+        # instrumentation run the plain methods at no cost
+        timed = instrumentation.timed
+
+        # _accept covers async_send calls on the loop and handed off ones
+        self._accept = timed('async_send', self._accept)
+
+        new_message = self._new_message
+
+        def _new_message(url, data, headers, success_cb, failure_cb,
+                         **kwargs):
+            return new_message(url, data, headers,
+                               timed('callback', success_cb),
+                               timed('callback', failure_cb), **kwargs)
+
+        self._new_message = _new_message
+
+        do_send = self._do_send
+        self._do_send = lambda message: instrumentation.timed_steps(
+            'send', do_send(message))
+
+        instrumentation.start(self._loop)
+
+    @property
+    def keepalive(self):
+        return self._keepalive
+
+    @property
+    def family(self):
+        return self._family
+
+    @property
+    def pending(self):
+        """Number of accepted messages without an outcome yet."""
+        return len(self._outstanding)
+
+    @property
+    def rate_limited(self):
+        return self._rate_limit_remaining() > 0
+
+    @property
+    def rate_limit_stats(self):
+        return {
+            'held': self.stats.rate_limit_held,
+            'dropped': self.stats.rate_limit_dropped,
+        }
+
+    def _rate_limit_remaining(self):
+        return max(0, self._rate_limited_until - self._loop.time())
+
+    def _set_rate_limited(self, retry_after):
+        if retry_after <= 0:
+            return
+
+        self._rate_limited_until = max(
+            self._rate_limited_until,
+            self._loop.time() + retry_after,
+        )
+
+    def _client_session_factory(self):
+        connector = aiohttp.TCPConnector(verify_ssl=self.verify_ssl,
+                                         family=self.family,
+                                         loop=self._loop,
+                                         **self._connector_kwargs)
+        return aiohttp.ClientSession(connector=connector,
+                                     loop=self._loop)
+
+    def _get_client_session(self, url):
+        pid = os.getpid()
+
+        if self._client_session_pid != pid:
+            # a session inherited through fork() shares its connections
+            # with the parent process, it is left to the parent
+            registry = self._session_registry
+            if registry is None:
+                self._client_session = self._client_session_factory()
+            else:
+                scheme, host = urllib.parse.urlsplit(url)[:2]
+                self._session_key = (self._loop, scheme, host, pid)
+                self._client_session = registry.acquire(
+                    self._session_key, self._client_session_factory)
+
+            self._client_session_pid = pid
+
+        return self._client_session
+
+    def _prepare_request(self, url, headers):
+        static = dict(headers)
+        auth = static.pop(AUTH_HEADER, None)
+
+        template = self._templates.get(url)
+        if template is None or template.static != static:
+            if len(self._templates) >= self.MAX_TEMPLATES:
+                self._templates.clear()
+
+            template = self._templates[url] = _RequestTemplate(url, static)
+
+        headers = template.headers.copy()
+        if auth is not None:
+            headers[AUTH_HEADER] = auth
+
+        return template.url, headers
+
+    @asyncio.coroutine
+    def _post(self, url, data, headers):
+        breaker = self._circuit_breaker
+        if breaker is not None and not breaker.allow(self._loop.time()):
+            raise CircuitOpen('Sentry is unreachable, circuit breaker is open')
+
+        session = self._get_client_session(url)
+        url, headers = self._prepare_request(url, headers)
+
+        stats = self.stats
+        stats.requests += 1
+        stats.in_flight += 1
+        started = self._loop.time()
+
+        resp = None
+
+        try:
+            resp = yield from session.post(
+                url,
+                data=data,
+                compress=False,
+                headers=headers,
+                timeout=self.timeout
+            )
+
+            code = resp.status
+            if code != 200:
+                stats.failed += 1
+                msg = resp.headers.get('x-sentry-error')
+                if code == 429:
+                    stats.status_429 += 1
+                    try:
+                        retry_after = resp.headers.get('retry-after')
+                        retry_after = int(retry_after)
+                    except (ValueError, TypeError):
+                        retry_after = 0
+                    self._set_rate_limited(retry_after)
+                    raise RateLimited(msg, retry_after)
+                else:
+                    if code >= 500:
+                        stats.status_5xx += 1
+                    elif code >= 400:
+                        stats.status_4xx += 1
+                    raise APIError(msg, code)
+
+            stats.succeeded += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            if not isinstance(exc, APIError):
+                stats.failed += 1
+                stats.errors += 1
+
+            if breaker is not None:
+                if self._is_unreachable(exc):
+                    breaker.failure(self._loop.time())
+                else:
+                    # any answer from Sentry proves it is reachable
+                    breaker.success()
+            raise
+        else:
+            if breaker is not None:
+                breaker.success()
+        finally:
+            stats.in_flight -= 1
+            stats.observe_latency(self._loop.time() - started)
+
+            if resp is not None:
+                resp.release()
+
+    @asyncio.coroutine
+    def _do_send(self, message):
+        message.attempt += 1
+
+        try:
+            yield from self._post(message.url, message.data, message.headers)
+        except asyncio.CancelledError:
+            # do not mute asyncio.CancelledError
+            raise
+        except Exception as exc:
+            self._send_failed(message, exc)
+        else:
+            self._succeeded(message)
+
+            if self._spool is not None:
+                self._maybe_replay()
+
+    @asyncio.coroutine
+    def _wait_throttle(self):
+        if self._throttle is None:
+            return
+
+        delay = self._throttle.reserve(self._loop.time())
+        if delay:
+            yield from asyncio.sleep(delay, loop=self._loop)
+
+    @staticmethod
+    def _is_unreachable(exc):
+        if isinstance(exc, CircuitOpen):
+            return True
+
+        if isinstance(exc, APIError):
+            return exc.code >= 500
+
+        return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError,
+                                OSError))
+
+    def _send_failed(self, message, exc):
+        delay = self._get_retry_delay(message, exc)
+        if delay is None:
+            if self._spool is not None and self._is_unreachable(exc):
+                self._spool_message(message)
+            else:
+                self._failed(message, exc)
+            return
+
+        self.stats.retried += 1
+
+        handle = self._loop.call_later(delay, self._retry, message)
+        self._retries[message] = handle
+
+    def _get_retry_delay(self, message, exc):
+        policy = self._retry_policy
+
+        if policy is None or self._closing:
+            return None
+
+        if message.attempt >= policy.attempts:
+            return None
+
+        if not policy.is_retryable(exc):
+            return None
+
+        delay = policy.get_delay(message.attempt)
+
+        if policy.deadline is not None:
+            elapsed = self._loop.time() - message.created
+            if elapsed + delay > policy.deadline:
+                return None
+
+        return delay
+
+    def _retry(self, message):
+        del self._retries[message]
+
+        self._async_send(message)
+
+    def _purge_dedup(self):
+        self._dedup.purge(self._loop.time())
+
+        self._dedup_handle = self._loop.call_later(
+            self._dedup.window, self._purge_dedup)
+
+    def _spool_message(self, message):
+        self.stats.spooled += 1
+        self._settle(message)
+        self._spool_buffer.append(message)
+
+        if self._spool_writing is None:
+            self._spool_write()
+
+    def _spool_write(self):
+        records = [
+            (message.url, message.headers, message.data)
+            for message in self._spool_buffer
+        ]
+        self._spool_buffer = []
+
+        self._spool_writing = self._loop.run_in_executor(
+            self._spool.executor, self._spool.write, records)
+        self._spool_writing.add_done_callback(self._spool_written)
+
+    def _spool_written(self, fut):
+        self._spool_writing = None
+
+        if not fut.cancelled() and fut.exception() is not None:
+            logging.getLogger('sentry.errors').error(
+                'Failed to write to the spool', exc_info=fut.exception())
+
+        if self._spool_buffer:
+            self._spool_write()
+
+    def _maybe_replay(self):
+        if self._spool_replay is not None or self._closing:
+            return
+
+        if not self._spool.size and self._spool_writing is None:
+            return
+
+        self._spool_replay = ensure_future(self._replay(), loop=self._loop)
+        self._spool_replay.add_done_callback(self._replay_done)
+
+    def _replay_done(self, fut):
+        self._spool_replay = None
+
+        if not fut.cancelled() and fut.exception() is not None:
+            logging.getLogger('sentry.errors').error(
+                'Failed to replay the spool', exc_info=fut.exception())
+
+    def _is_busy(self):
+        return False
+
+    @asyncio.coroutine
+    def _replay(self):
+        """Send spooled messages one by one while the transport is idle.
+
+        Stops at the first failure which means Sentry is unreachable again,
+        the position is kept so the next replay resumes from there.
+        """
+        spool = self._spool
+
+        # messages spooled before the replay started are part of it
+        while self._spool_writing is not None or self._spool_buffer:
+            if self._spool_writing is None:
+                self._spool_write()
+
+            yield from asyncio.wait([self._spool_writing], loop=self._loop)
+
+        segments = yield from self._loop.run_in_executor(
+            spool.executor, spool.seal)
+
+        for segment in segments:
+            offset = self._spool_offsets.get(segment, 0)
+
+            while True:
+                records = yield from self._loop.run_in_executor(
+                    spool.executor, spool.read, segment, offset)
+
+                if not records:
+                    break
+
+                for end, (url, headers, data) in records:
+                    self._spool_offsets[segment] = offset
+
+                    while self._is_busy():
+                        yield from asyncio.sleep(0.1, loop=self._loop)
+
+                    if self.rate_limited:
+                        return
+
+                    yield from self._wait_throttle()
+
+                    try:
+                        yield from self._post(url, data, headers)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as exc:
+                        if self._is_unreachable(exc) or \
+                                isinstance(exc, RateLimited):
+                            return
+
+                        spool.replay_failed += 1
+                    else:
+                        spool.replayed += 1
+
+                    offset = end
+
+            self._spool_offsets.pop(segment, None)
+
+            yield from self._loop.run_in_executor(
+                spool.executor, spool.remove, segment)
+
+    def _settle(self, message):
+        self._outstanding.discard(message)
+
+        if self._flush_waiters:
+            pending = len(self._outstanding)
+            waiters, self._flush_waiters = self._flush_waiters, []
+
+            for limit, waiter in waiters:
+                if pending > limit:
+                    self._flush_waiters.append((limit, waiter))
+                elif not waiter.done():
+                    waiter.set_result(None)
+
+    @asyncio.coroutine
+    def _wait_pending(self, limit):
+        """Wait until at most ``limit`` accepted messages are outstanding."""
+        if len(self._outstanding) <= limit:
+            return
+
+        entry = (limit, asyncio.Future(loop=self._loop))
+        self._flush_waiters.append(entry)
+
+        try:
+            yield from entry[1]
+        except asyncio.CancelledError:
+            if entry in self._flush_waiters:
+                self._flush_waiters.remove(entry)
+            raise
+
+    def _succeeded(self, message):
+        self.stats.delivered += 1
+        self._settle(message)
+
+        message.success_cb()
+
+    def _failed(self, message, exc):
+        self.stats.undelivered += 1
+        self._settle(message)
+
+        message.failure_cb(exc)
+
+    def _drop(self, message, reason):
+        self.stats.dropped += 1
+
+        if self._spool is not None:
+            self._spool_message(message)
+            return
+
+        # no callback, a storm of drops would become a storm of log records
+        self.stats.undelivered += 1
+        self._settle(message)
+
+        self._drops[reason] += 1
+        if self._drop_report_handle is None:
+            self._drop_report_handle = self._loop.call_later(
+                self._drop_report_interval, self._report_drops)
+
+    def _report_drops(self):
+        self._drop_report_handle = None
+
+        drops, self._drops = self._drops, collections.Counter()
+        if drops:
+            self._drop_report(dict(drops))
+
+    @staticmethod
+    def _log_drops(drops):
+        logger = logging.getLogger('sentry.errors')
+        for reason, count in sorted(drops.items()):
+            logger.warning('Dropped %d messages: %s', count, reason)
+
+    @asyncio.coroutine
+    def _cancel_pending(self):
+        """Cancel all sends in flight and empty internal queues."""
+
+    @asyncio.coroutine
+    def _abort_pending(self, reason):
+        """Give up on all messages which have no outcome yet.
+
+        Messages are spooled if possible, otherwise their failure callback
+        is called with ``reason``.
+        """
+        retries, self._retries = self._retries, {}
+        for handle in retries.values():
+            handle.cancel()
+
+        yield from self._cancel_pending()
+
+        for message in list(self._outstanding):
+            if self._spool is not None:
+                self._spool_message(message)
+            else:
+                self._failed(message, RuntimeError(reason))
+
+    @asyncio.coroutine
+    def _close_spool(self):
+        while self._spool_writing is not None:
+            yield from asyncio.wait([self._spool_writing], loop=self._loop)
+
+        yield from self._loop.run_in_executor(
+            self._spool.executor, self._spool.close)
+
+        self._spool.executor.shutdown(wait=False)
+
+    def _export_stats(self):
+        self._stats_handle = self._loop.call_later(
+            self._stats_interval, self._export_stats)
+
+        self._stats_callback(self.stats.snapshot())
+
+    def _flush_retries(self):
+        retries, self._retries = self._retries, {}
+
+        for message, handle in retries.items():
+            handle.cancel()
+            self._async_send(message)
+
+    @abc.abstractmethod
+    def _async_send(self, message):  # pragma: no cover
+        pass
+
+    @abc.abstractmethod
+    @asyncio.coroutine
+    def _close(self):  # pragma: no cover
+        pass
+
+    def _set_loop_thread(self):
+        self._loop_thread = threading.get_ident()
+
+    def _in_foreign_thread(self):
+        if not self._loop.is_running():
+            return False
+
+        if _get_running_loop is not None:
+            return _get_running_loop() is not self._loop
+
+        # until the loop has recorded its thread every caller is foreign
+        return threading.get_ident() != self._loop_thread
+
+    def _drain_handoff(self):
+        # reset first, a send handed over meanwhile schedules another drain
+        self._handoff_scheduled = False
+
+        handoff = self._handoff
+        while handoff:
+            args, priority = handoff.popleft()
+            self._accept(*args, priority=priority)
+
+    def async_send(self, url, data, headers, success_cb, failure_cb, *,
+                   priority=None):
+        args = (url, data, headers, success_cb, failure_cb)
+
+        if self._in_foreign_thread():
+            # deque operations are atomic, the loop is woken up once for
+            # all sends handed over until the next drain
+            self._handoff.append((args, priority))
+
+            if not self._handoff_scheduled:
+                self._handoff_scheduled = True
+                self._loop.call_soon_threadsafe(self._drain_handoff)
+            return
+
+        self._accept(*args, priority=priority)
+
+    def _accept(self, url, data, headers, success_cb, failure_cb, *,
+                priority=None):
+        message = self._new_message(url, data, headers, success_cb,
+                                    failure_cb, priority=priority)
+        if message is not None:
+            self._async_send(message)
+
+    def _new_message(self, url, data, headers, success_cb, failure_cb, *,
+                     priority=None):
+        if self._closing:
+            failure_cb(RuntimeError(
+                '{} is closed'.format(self.__class__.__name__)))
+            return None
+
+        if self._dedup is not None:
+            if not self._dedup.forward(data, headers, self._loop.time()):
+                return None
+
+        limit = self._max_payload_size
+        if limit is not None and len(data) > limit:
+            trimmed = self._trim(data, headers, limit)
+
+            if len(trimmed) > limit:
+                self.stats.oversized += 1
+                failure_cb(PayloadTooLarge(len(data), limit))
+                return None
+
+            self.stats.trimmed += 1
+            data = trimmed
+
+        if priority is None:
+            if self._priority is None:
+                priority = 0
+            else:
+                priority = self._priority(data, headers)
+
+        message = _Message(url, data, headers, success_cb, failure_cb,
+                           priority=priority, created=self._loop.time())
+
+        self._outstanding.add(message)
+        return message
+
+    def _trim(self, data, headers, limit):
+        if self._trimmer is None:
+            return data
+
+        try:
+            return self._trimmer(data, headers, limit)
+        except (ValueError, zlib.error):
+            # not a JSON event, rejected as it is
+            return data
+
+    @asyncio.coroutine
+    def flush(self, timeout=None, *, cancel=False):
+        """Wait until every accepted message is delivered, failed or spooled.
+
+        Returns the number of messages ``delivered``, ``failed`` and
+        ``spooled`` during the call and the number still ``pending`` at its
+        end. With ``cancel=True`` messages left at the deadline are cancelled
+        and spooled or failed, the transport stays usable.
+        """
+        # sends handed over by other threads are part of the flush
+        self._drain_handoff()
+
+        stats = self.stats
+        delivered = stats.delivered
+        undelivered = stats.undelivered
+        spooled = stats.spooled
+
+        if self._outstanding:
+            try:
+                yield from asyncio.wait_for(self._wait_pending(0), timeout,
+                                            loop=self._loop)
+            except asyncio.TimeoutError:
+                if cancel:
+                    yield from self._abort_pending(
+                        '{} flush timed out before the message was '
+                        'sent'.format(self.__class__.__name__))
+
+        return {
+            'delivered': stats.delivered - delivered,
+            'failed': stats.undelivered - undelivered,
+            'spooled': stats.spooled - spooled,
+            'pending': len(self._outstanding),
+        }
+
+    @asyncio.coroutine
+    def _close_coro(self, *, timeout=None):
+        # pending retries are sent right away instead of being dropped
+        self._flush_retries()
+
+        if self._spool_replay is not None:
+            self._spool_replay.cancel()
+
+        if self._stats_handle is not None:
+            self._stats_handle.cancel()
+
+        if self._dedup is not None:
+            self._dedup_handle.cancel()
+            self._dedup.purge(self._loop.time(), everything=True)
+
+        try:
+            yield from asyncio.wait_for(
+                self._close(), timeout=timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            yield from self._abort_pending(
+                '{} closed before the message was sent'.format(
+                    self.__class__.__name__))
+        finally:
+            if self._spool is not None:
+                yield from self._close_spool()
+
+            if self._client_session_pid == os.getpid():
+                if self._session_registry is None:
+                    yield from self._client_session.close()
+                else:
+                    yield from self._session_registry.release(
+                        self._session_key)
+
+            if self._drop_report_handle is not None:
+                self._drop_report_handle.cancel()
+                self._report_drops()
+
+            if self._instrumentation is not None:
+                self._instrumentation.stop()
+
+            if self._stats_callback is not None:
+                self._stats_callback(self.stats.snapshot())
+
+    def close(self, *, timeout=None):
+        if self._closing:
+            @asyncio.coroutine
+            def dummy():
+                pass
+
+            return dummy()
+
+        # sends handed over by other threads before close() are accepted
+        self._drain_handoff()
+
+        self._closing = True
+
+        return self._close_coro(timeout=timeout)
+
+    if not has_newstyle_transports:
+        oldstyle_async_send = async_send
+
+        def async_send(self, *args, **kwargs):
+            return self.oldstyle_async_send(self._url, *args, **kwargs)
+
+
+class AioHttpTransport(AioHttpTransportBase):
+
+    OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'buffer')
+
+    def __init__(self, *args, max_in_flight=None, overflow='drop_newest',
+                 buffer_size=100, **kwargs):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {}'.format(
+                ', '.join(self.OVERFLOW_POLICIES)))
+
+        super().__init__(*args, **kwargs)
+
+        self._max_in_flight = max_in_flight
+        self._overflow_policy = overflow
+        self._buffer_size = buffer_size
+
+        # insertion ordered, the first task is the oldest send
+        self._tasks = collections.OrderedDict()
+        self._buffer = collections.deque()
+
+        self.stats.gauges['tasks'] = lambda: len(self._tasks)
+        self.stats.gauges['buffered'] = lambda: len(self._buffer)
+
+    def _async_send(self, message):
+        retry_after = self._rate_limit_remaining()
+        if retry_after:
+            self.stats.rate_limit_dropped += 1
+            self._failed(message, RateLimited(
+                'AioHttpTransport is rate limited',
+                int(math.ceil(retry_after))))
+            return
+
+        throttle = self._throttle
+        if throttle is not None and \
+                not throttle.try_acquire(self._loop.time()):
+            self._drop(message, 'AioHttpTransport outbound rate limit exceeded')
+            return
+
+        if self._max_in_flight is not None and \
+                len(self._tasks) >= self._max_in_flight:
+            self._overflow(message)
+            return
+
+        self._spawn(message)
+
+    def _spawn(self, message):
+        coro = self._do_send(message)
+
+        task = ensure_future(coro, loop=self._loop)
+        self._tasks[task] = message
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.pop(task, None)
+
+        if self._buffer and len(self._tasks) < self._max_in_flight:
+            self._spawn(self._buffer.popleft())
+
+    def _overflow(self, message):
+        policy = self._overflow_policy
+
+        if policy == 'buffer':
+            if len(self._buffer) < self._buffer_size:
+                self._buffer.append(message)
+                return
+        elif policy == 'drop_oldest':
+            for task, oldest in self._tasks.items():
+                if not task.done():
+                    break
+            else:
+                # all sends are finished, their callbacks are pending
+                self._spawn(message)
+                return
+
+            del self._tasks[task]
+            task.cancel()
+
+            self._spawn(message)
+            message = oldest
+
+        self._drop(message, 'AioHttpTransport has too many sends in flight '
+                            '(policy: {})'.format(policy))
+
+    def _is_busy(self):
+        return bool(self._tasks)
+
+    @asyncio.coroutine
+    def _cancel_pending(self):
+        self._buffer.clear()
+
+        for task in self._tasks:
+            task.cancel()
+
+        if self._tasks:
+            yield from asyncio.wait(list(self._tasks), loop=self._loop)
+
+    @asyncio.coroutine
+    def _close(self):
+        # finished sends start the buffered ones
+        while self._tasks:
+            yield from asyncio.gather(
+                *self._tasks,
+                return_exceptions=True,
+                loop=self._loop
+            )
+
+        assert len(self._buffer) == 0
+
+
+class QueuedAioHttpTransport(AioHttpTransportBase):
+
+    # drop_oldest sheds the least important message, oldest first
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block', 'sample')
+
+    def __init__(self, *args, workers=1, qsize=1000, qbytes=None,
+                 max_workers=None,
+                 scale_up_depth=10, scale_up_wait=1.0, idle_timeout=30,
+                 overflow='drop_oldest', block_timeout=1.0,
+                 sample_threshold=0.5, **kwargs):
+        if max_workers is None:
+            max_workers = workers
+
+        if max_workers < workers:
+            raise ValueError('max_workers must not be less than workers')
+
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of {}'.format(
+                ', '.join(self.OVERFLOW_POLICIES)))
+
+        super().__init__(*args, **kwargs)
+
+        self._overflow_policy = overflow
+        self._block_timeout = block_timeout
+        self._sample_threshold = sample_threshold
+
+        self._queue = _PriorityQueue(maxsize=qsize, maxbytes=qbytes,
+                                     loop=self._loop)
+
+        self._min_workers = workers
+        self._max_workers = max_workers
+        self._scale_up_depth = scale_up_depth
+        self._scale_up_wait = scale_up_wait
+        self._idle_timeout = idle_timeout
+
+        self._workers = set()
+        self._worker_count = 0
+        self._idle_workers = 0
+
+        for _ in range(workers):
+            self._spawn_worker()
+
+        self.stats.gauges['queue_depth'] = self._queue.qsize
+        self.stats.gauges['queue_bytes'] = lambda: self._queue.nbytes
+        self.stats.gauges['workers'] = lambda: self._worker_count
+
+    @property
+    def worker_count(self):
+        return self._worker_count
+
+    @property
+    def queued_bytes(self):
+        """Payload bytes of the messages waiting in the queue."""
+        return self._queue.nbytes
+
+    def _spawn_worker(self):
+        self._worker_count += 1
+
+        worker = ensure_future(self._run_worker(), loop=self._loop)
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.remove)
+
+    def _maybe_scale_up(self):
+        if self._closing or self._worker_count >= self._max_workers:
+            return
+
+        backlog = self._queue.qsize() - self._idle_workers
+        if backlog >= self._scale_up_depth:
+            self._spawn_worker()
+
+    @asyncio.coroutine
+    def _run_worker(self):
+        try:
+            yield from self._worker()
+        finally:
+            self._worker_count -= 1
+
+    @asyncio.coroutine
+    def _get_message(self):
+        """Wait for the next message.
+
+        Returns ``None`` when the calling worker should retire because it
+        stayed idle for ``idle_timeout`` and the pool is above its minimum.
+        """
+        self._idle_workers += 1
+
+        try:
+            while self._worker_count > self._min_workers:
+                try:
+                    return (yield from asyncio.wait_for(
+                        self._queue.get(), self._idle_timeout,
+                        loop=self._loop))
+                except asyncio.TimeoutError:
+                    if self._worker_count > self._min_workers:
+                        return None
+
+            return (yield from self._queue.get())
+        finally:
+            self._idle_workers -= 1
+
+    def _check_wait_time(self, message):
+        waited = self._loop.time() - message.enqueued
+        if waited >= self._scale_up_wait and \
+                self._worker_count < self._max_workers and \
+                not self._closing:
+            self._spawn_worker()
+
+    @asyncio.coroutine
+    def _worker(self):
+        while True:
+            message = yield from self._get_message()
+            if message is None:
+                break
+
+            try:
+                if message is ...:
+                    self._queue.put_nowait(...)
+                    break
+
+                self._check_wait_time(message)
+
+                yield from self._wait_rate_limit()
+
+                yield from self._wait_throttle()
+
+                yield from self._do_send(message)
+            finally:
+                self._queue.task_done()
+
+    @asyncio.coroutine
+    def _wait_rate_limit(self):
+        retry_after = self._rate_limit_remaining()
+        if not retry_after:
+            return
+
+        self.stats.rate_limit_held += 1
+
+        # the window may be extended by in-flight sends while sleeping
+        while retry_after:
+            yield from asyncio.sleep(retry_after, loop=self._loop)
+            retry_after = self._rate_limit_remaining()
+
+    def _async_send(self, message):
+        message.enqueued = self._loop.time()
 
-        if self.keepalive:
-            self._client_session = self._client_session_factory()
+        if self._overflow_policy == 'sample' and self._sample_out():
+            self._overflow(message, 'QueuedAioHttpTransport internal queue '
+                                    'is filling up')
+            return
 
-        self._closing = False
+        queue = self._queue
+        size = len(message.data)
 
-    @property
-    def keepalive(self):
-        return self._keepalive
+        if queue.too_large(size):
+            self._overflow(message, 'QueuedAioHttpTransport message exceeds '
+                                    'the queue byte budget')
+            return
 
-    @property
-    def family(self):
-        return self._family
+        if queue.has_room(size):
+            queue.put_nowait(message)
+        elif self._overflow_policy == 'drop_oldest' and \
+                queue.can_shed_room(size, message.priority):
+            # a large message may take the room of several others
+            while not queue.has_room(size):
+                lowest = queue.shed_nowait()
+                queue.task_done()
 
-    def _client_session_factory(self):
-        connector = aiohttp.TCPConnector(verify_ssl=self.verify_ssl,
-                                         family=self.family,
-                                         loop=self._loop)
-        return aiohttp.ClientSession(connector=connector,
-                                     loop=self._loop)
+                self._overflow(lowest, 'QueuedAioHttpTransport internal '
+                                       'queue is full')
 
-    @asyncio.coroutine
-    def _do_send(self, url, data, headers, success_cb, failure_cb):
-        if self.keepalive:
-            session = self._client_session
+            queue.put_nowait(message)
         else:
-            session = self._client_session_factory()
+            self._overflow(message, 'QueuedAioHttpTransport internal queue '
+                                    'is full')
 
-        resp = None
+        self._maybe_scale_up()
 
-        try:
-            resp = yield from session.post(
-                url,
-                data=data,
-                compress=False,
-                headers=headers,
-                timeout=self.timeout
-            )
+    def _sample_out(self):
+        """Random early drop, more likely the fuller the queue is."""
+        queue = self._queue
 
-            code = resp.status
-            if code != 200:
-                msg = resp.headers.get('x-sentry-error')
-                if code == 429:
-                    try:
-                        retry_after = resp.headers.get('retry-after')
-                        retry_after = int(retry_after)
-                    except (ValueError, TypeError):
-                        retry_after = 0
-                    failure_cb(RateLimited(msg, retry_after))
-                else:
-                    failure_cb(APIError(msg, code))
-            else:
-                success_cb()
-        except asyncio.CancelledError:
-            # do not mute asyncio.CancelledError
-            raise
-        except Exception as exc:
-            failure_cb(exc)
-        finally:
-            if resp is not None:
-                resp.release()
-            if not self.keepalive:
-                yield from session.close()
+        fill = 0
+        if queue.maxsize > 0:
+            fill = queue.qsize() / queue.maxsize
+        if queue.maxbytes:
+            fill = max(fill, queue.nbytes / queue.maxbytes)
 
-    @abc.abstractmethod
-    def _async_send(self, url, data, headers, success_cb, failure_cb):  # pragma: no cover
-        pass
+        threshold = self._sample_threshold
+        if fill < threshold:
+            return False
+
+        # accepted with probability (1 - fill) / (1 - threshold)
+        return random.random() * (1 - threshold) >= 1 - fill
 
-    @abc.abstractmethod
     @asyncio.coroutine
-    def _close(self):  # pragma: no cover
-        pass
+    def enqueue(self, url, data, headers, success_cb, failure_cb, *,
+                priority=None, timeout=None):
+        """Coroutine version of ``async_send()``.
 
-    def async_send(self, url, data, headers, success_cb, failure_cb):
-        if self._closing:
-            failure_cb(RuntimeError(
-                '{} is closed'.format(self.__class__.__name__)))
+        With the ``block`` overflow policy it waits up to ``timeout``
+        (``block_timeout`` by default) for room in the queue before the
+        message is dropped.
+        """
+        message = self._new_message(url, data, headers, success_cb,
+                                    failure_cb, priority=priority)
+        if message is None:
             return
 
-        self._async_send(url, data, headers, success_cb, failure_cb)
+        size = len(message.data)
+        queue = self._queue
 
-    @asyncio.coroutine
-    def _close_coro(self, *, timeout=None):
-        try:
-            yield from asyncio.wait_for(
-                self._close(), timeout=timeout, loop=self._loop)
-        except asyncio.TimeoutError:
-            pass
-        finally:
-            if self.keepalive:
-                yield from self._client_session.close()
+        if self._overflow_policy == 'block' and not queue.has_room(size) and \
+                not queue.too_large(size):
+            if timeout is None:
+                timeout = self._block_timeout
 
-    def close(self, *, timeout=None):
-        if self._closing:
-            @asyncio.coroutine
-            def dummy():
+            try:
+                yield from asyncio.wait_for(queue.wait_room(size), timeout,
+                                            loop=self._loop)
+            except asyncio.TimeoutError:
                 pass
 
-            return dummy()
+        # drops the message if there is still no room
+        self._async_send(message)
 
-        self._closing = True
+    def _overflow(self, message, reason):
+        self._drop(message, '{} (policy: {})'.format(
+            reason, self._overflow_policy))
 
-        return self._close_coro(timeout=timeout)
+    def _is_busy(self):
+        return self._queue.qsize() > 0
 
-    if not has_newstyle_transports:
-        oldstyle_async_send = async_send
+    @asyncio.coroutine
+    def _cancel_pending(self):
+        for worker in self._workers:
+            worker.cancel()
 
-        def async_send(self, *args, **kwargs):
-            return self.oldstyle_async_send(self._url, *args, **kwargs)
+        if self._workers:
+            yield from asyncio.wait(list(self._workers), loop=self._loop)
 
+        while True:
+            try:
+                self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
 
-class AioHttpTransport(AioHttpTransportBase):
+            self._queue.task_done()
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        if not self._closing:
+            for _ in range(self._min_workers):
+                self._spawn_worker()
 
-        self._tasks = set()
+    @asyncio.coroutine
+    def _close(self):
+        try:
+            self._queue.put_nowait(...)
+        except asyncio.QueueFull as exc:
+            skipped = self._queue.shed_nowait()
+            self._queue.task_done()
 
-    def _async_send(self, url, data, headers, success_cb, failure_cb):
-        coro = self._do_send(url, data, headers, success_cb, failure_cb)
+            self._overflow(skipped, 'QueuedAioHttpTransport internal queue '
+                                    'was full')
 
-        task = ensure_future(coro, loop=self._loop)
-        self._tasks.add(task)
-        task.add_done_callback(self._tasks.remove)
+            self._queue.put_nowait(...)
 
-    @asyncio.coroutine
-    def _close(self):
         yield from asyncio.gather(
-            *self._tasks,
+            *self._workers,
             return_exceptions=True,
             loop=self._loop
         )
 
-        assert len(self._tasks) == 0
+        assert len(self._workers) == 0
+        assert self._queue.qsize() == 1
+        try:
+            assert self._queue.get_nowait() is ...
+        finally:
+            self._queue.task_done()
 
 
-class QueuedAioHttpTransport(AioHttpTransportBase):
+class BatchedAioHttpTransport(QueuedAioHttpTransport):
+    """Queued transport which coalesces messages into envelope requests.
 
-    def __init__(self, *args, workers=1, qsize=1000, **kwargs):
-        super().__init__(*args, **kwargs)
+    A batch is sent once it holds ``batch_size`` messages, reaches
+    ``batch_bytes`` of payload or ``linger`` seconds have passed since its
+    first message was taken from the queue.
 
-        self._queue = asyncio.Queue(maxsize=qsize, loop=self._loop)
+    Sentry accepts a single event per envelope, so by default every message
+    of a batch is posted concurrently as its own envelope to the DSN's
+    envelope endpoint. Only ``envelope_url``, an endpoint which accepts
+    several event items per envelope, receives a batch as one request.
+    """
 
-        self._workers = set()
+    ENVELOPE_CONTENT_TYPE = 'application/x-sentry-envelope'
 
-        for _ in range(workers):
-            worker = ensure_future(self._worker(), loop=self._loop)
-            self._workers.add(worker)
-            worker.add_done_callback(self._workers.remove)
+    def __init__(self, *args, batch_size=100, batch_bytes=1024 * 1024,
+                 linger=0.05, envelope_url=None, **kwargs):
+        self._batch_size = batch_size
+        self._batch_bytes = batch_bytes
+        self._linger = linger
+        self._envelope_url = envelope_url
+
+        super().__init__(*args, **kwargs)
+
+    def _instrument(self, instrumentation):
+        super()._instrument(instrumentation)
+
+        do_send_batch = self._do_send_batch
+        self._do_send_batch = lambda url, messages: \
+            instrumentation.timed_steps('send', do_send_batch(url, messages))
 
     @asyncio.coroutine
     def _worker(self):
         while True:
-            data = yield from self._queue.get()
+            message = yield from self._get_message()
+            if message is None:
+                break
+
+            if message is ...:
+                self._queue.put_nowait(...)
+                self._queue.task_done()
+                break
+
+            self._check_wait_time(message)
+
+            batch = [message]
 
             try:
-                if data is ...:
-                    self._queue.put_nowait(...)
-                    break
+                yield from self._fill_batch(batch)
 
-                url, data, headers, success_cb, failure_cb = data
+                yield from self._wait_rate_limit()
 
-                yield from self._do_send(url, data, headers, success_cb,
-                                         failure_cb)
+                yield from self._wait_throttle()
+
+                batches = collections.OrderedDict()
+                for message in batch:
+                    batches.setdefault(message.url, []).append(message)
+
+                for url, messages in batches.items():
+                    yield from self._do_send_batch(url, messages)
             finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    @asyncio.coroutine
+    def _fill_batch(self, batch):
+        size = len(batch[0].data)
+        deadline = self._loop.time() + self._linger
+
+        while len(batch) < self._batch_size and size < self._batch_bytes:
+            try:
+                message = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    message = yield from asyncio.wait_for(
+                        self._queue.get(), timeout, loop=self._loop)
+                except asyncio.TimeoutError:
+                    break
+
+            if message is ...:
+                # leave the sentinel for the other workers and ourselves
+                self._queue.put_nowait(...)
                 self._queue.task_done()
+                break
+
+            batch.append(message)
+            size += len(message.data)
+
+    @staticmethod
+    def _dsn_envelope_url(url):
+        if url.endswith('/store/'):
+            url = url[:-len('store/')] + 'envelope/'
+
+        return url
+
+    def _encode_envelope(self, messages):
+        chunks = [b'{}']
+
+        for message in messages:
+            payload = message.data
+            if message.headers.get('Content-Encoding') == 'deflate':
+                payload = zlib.decompress(payload)
+
+            header = '{{"type":"event","length":{}}}'.format(len(payload))
+            chunks.append(header.encode('utf-8'))
+            chunks.append(payload)
+
+        data = zlib.compress(b'\n'.join(chunks))
+
+        headers = dict(messages[0].headers)
+        headers['Content-Encoding'] = 'deflate'
+        headers['Content-Type'] = self.ENVELOPE_CONTENT_TYPE
+
+        return data, headers
+
+    @asyncio.coroutine
+    def _do_send_batch(self, url, messages):
+        if self._envelope_url is not None:
+            yield from self._send_envelope(self._envelope_url, messages)
+            return
 
-    def _async_send(self, url, data, headers, success_cb, failure_cb):
-        data = url, data, headers, success_cb, failure_cb
+        url = self._dsn_envelope_url(url)
+        yield from asyncio.gather(*[
+            self._send_envelope(url, [message]) for message in messages
+        ], loop=self._loop)
+
+    @asyncio.coroutine
+    def _send_envelope(self, url, messages):
+        for message in messages:
+            message.attempt += 1
 
         try:
-            self._queue.put_nowait(data)
-        except asyncio.QueueFull as exc:
-            skipped = self._queue.get_nowait()
-            self._queue.task_done()
+            data, headers = self._encode_envelope(messages)
+
+            yield from self._post(url, data, headers)
+        except asyncio.CancelledError:
+            # do not mute asyncio.CancelledError
+            raise
+        except Exception as exc:
+            for message in messages:
+                self._send_failed(message, exc)
+        else:
+            for message in messages:
+                self._succeeded(message)
 
-            *_, failure_cb = skipped
+            if self._spool is not None:
+                self._maybe_replay()
 
-            failure_cb(RuntimeError(
-                'QueuedAioHttpTransport internal queue is full'))
 
-            self._queue.put_nowait(data)
+class RelayTransport(QueuedAioHttpTransport):
+    """Queued transport which hands events to a local ``RelayServer``.
+
+    Encoded events are written to the unix socket ``path`` instead of being
+    posted to Sentry, a message counts as sent once it is written. When the
+    relay falls behind, writes wait for the socket to drain, the queue fills
+    up and overflowing messages are dropped (``transport.stats.dropped``).
+    """
+
+    def __init__(self, *args, path, **kwargs):
+        self._path = path
+        self._writer = None
+        self._writer_pid = None
+
+        super().__init__(*args, **kwargs)
+
+        # concurrent drain() calls are not supported by asyncio
+        self._write_lock = asyncio.Lock(loop=self._loop)
+
+    @property
+    def path(self):
+        return self._path
+
+    def _disconnect(self):
+        if self._writer_pid == os.getpid():
+            self._writer.close()
+
+        self._writer = None
+        self._writer_pid = None
+
+    @asyncio.coroutine
+    def _post(self, url, data, headers):
+        stats = self.stats
+        stats.requests += 1
+        stats.in_flight += 1
+        started = self._loop.time()
+
+        try:
+            with (yield from self._write_lock):
+                # like sessions, connections are not shared with children
+                if self._writer_pid != os.getpid():
+                    _, self._writer = yield from asyncio.open_unix_connection(
+                        self._path, loop=self._loop)
+                    self._writer_pid = os.getpid()
+
+                self._writer.write(_pack_record(url, headers, data))
+                yield from self._writer.drain()
+
+            stats.succeeded += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats.failed += 1
+            stats.errors += 1
+
+            self._disconnect()
+            raise
+        finally:
+            stats.in_flight -= 1
+            stats.observe_latency(self._loop.time() - started)
 
     @asyncio.coroutine
     def _close(self):
         try:
-            self._queue.put_nowait(...)
-        except asyncio.QueueFull as exc:
-            skipped = self._queue.get_nowait()
-            self._queue.task_done()
+            yield from super()._close()
+        finally:
+            self._disconnect()
 
-            *_, failure_cb = skipped
 
-            failure_cb(RuntimeError(
-                'QueuedAioHttpTransport internal queue was full'))
+class RelayServer:
+    """Forwards events received from ``RelayTransport`` instances.
 
-            self._queue.put_nowait(...)
+    Listens on the unix socket ``path`` and sends every event with
+    ``transport``, a ``QueuedAioHttpTransport`` by default, so all processes
+    of a host share one connection pool and one rate limit. While
+    ``max_pending`` events wait for ``transport`` clients are not read from
+    (counted in ``held``). ``received``, ``delivered``, ``failed`` and
+    ``malformed`` count events, drops are reported by ``transport``.
+    """
 
-        yield from asyncio.gather(
-            *self._workers,
-            return_exceptions=True,
-            loop=self._loop
-        )
+    def __init__(self, path, *, transport=None, max_pending=1000, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
 
-        assert len(self._workers) == 0
-        assert self._queue.qsize() == 1
+        if transport is None:
+            transport = QueuedAioHttpTransport(loop=loop)
+
+        self.path = path
+        self.transport = transport
+        self.max_pending = max_pending
+
+        self.received = 0
+        self.delivered = 0
+        self.failed = 0
+        self.malformed = 0
+        self.held = 0
+
+        self._loop = loop
+        self._server = None
+        self._clients = set()
+        self._closing = False
+
+    @asyncio.coroutine
+    def start(self):
+        # a socket left behind by a previous run, not a file or the socket
+        # of a relay which is still running
         try:
-            assert self._queue.get_nowait() is ...
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if stat.S_ISSOCK(mode) and not (yield from self._in_use()):
+                os.unlink(self.path)
+
+        # bound here, asyncio would remove any socket at the path itself
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+        except OSError:
+            sock.close()
+            raise
+
+        self._server = yield from asyncio.start_unix_server(
+            self._handle_client, sock=sock, loop=self._loop)
+
+    @asyncio.coroutine
+    def _in_use(self):
+        try:
+            _, writer = yield from asyncio.open_unix_connection(
+                self.path, loop=self._loop)
+        except ConnectionRefusedError:
+            return False
+
+        writer.close()
+        return True
+
+    @asyncio.coroutine
+    def _handle_client(self, reader, writer):
+        self._clients.add(writer)
+
+        try:
+            while not self._closing:
+                if self.transport.pending >= self.max_pending:
+                    self.held += 1
+
+                    yield from self.transport._wait_pending(
+                        self.max_pending - 1)
+                    continue
+
+                header = yield from reader.readexactly(_RECORD.size)
+                meta_size, data_size = _RECORD.unpack(header)
+                meta = yield from reader.readexactly(meta_size)
+                data = yield from reader.readexactly(data_size)
+
+                self.received += 1
+
+                try:
+                    url, headers = json.loads(meta.decode('utf-8'))
+                except ValueError:
+                    self.malformed += 1
+                    continue
+
+                self.transport.async_send(url, data, headers,
+                                          self._delivered, self._failed)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the client went away
+            pass
         finally:
-            self._queue.task_done()
+            self._clients.discard(writer)
+            writer.close()
+
+    def _delivered(self):
+        self.delivered += 1
+
+    def _failed(self, exc):
+        self.failed += 1
+
+    @asyncio.coroutine
+    def close(self, *, timeout=None):
+        self._closing = True
+
+        self._server.close()
+        yield from self._server.wait_closed()
+
+        for writer in list(self._clients):
+            writer.close()
+
+        yield from self.transport.close(timeout=timeout)
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class AioHttpClient(Client):
+    """``raven.Client`` which encodes events off the event loop.
+
+    JSON serialization and zlib compression run in a pool of
+    ``encode_workers`` threads, the encoded event is handed to the transport
+    on the loop afterwards. With more than ``max_pending`` events waiting
+    for the pool, events are encoded inline again. Events must not be
+    mutated after they were captured.
+
+    Requires one of the asyncio transports of this module, falls back to
+    the plain ``raven.Client`` behaviour otherwise.
+    """
+
+    def __init__(self, *args, encode_workers=2, max_pending=100,
+                 compress_level=6, **kwargs):
+        self.compress_level = compress_level
+
+        self._encode_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=encode_workers)
+        self._max_pending = max_pending
+        self._encoding = set()
+
+        super().__init__(*args, **kwargs)
+
+    def encode(self, data):
+        return zlib.compress(raven_json.dumps(data).encode('utf8'),
+                             self.compress_level)
+
+    def send(self, auth_header=None, **data):
+        transport = self.remote.get_transport()
+
+        # calls from other threads encode inline, off the loop anyway
+        if not isinstance(transport, AioHttpTransportBase) or \
+                transport._in_foreign_thread() or \
+                len(self._encoding) >= self._max_pending:
+            return super().send(auth_header=auth_header, **data)
+
+        fut = transport._loop.run_in_executor(
+            self._encode_executor, self.encode, data)
+        self._encoding.add(fut)
+        fut.add_done_callback(functools.partial(self._encoded, auth_header))
+
+    def _encoded(self, auth_header, fut):
+        self._encoding.discard(fut)
+
+        if fut.cancelled():
+            return
+
+        exc = fut.exception()
+        if exc is not None:
+            self.error_logger.error('Failed to encode the event',
+                                    exc_info=exc)
+            return
+
+        self.send_encoded(fut.result(), auth_header=auth_header)
+
+    @asyncio.coroutine
+    def close(self, *, timeout=None):
+        """Wait for pending encodes, then close the transport."""
+        transport = self.remote.get_transport()
+
+        # no DSN or another transport, nothing was encoded off the loop
+        if not isinstance(transport, AioHttpTransportBase):
+            self._encode_executor.shutdown(wait=False)
+            return
+
+        loop = transport._loop
+
+        if timeout is not None:
+            deadline = loop.time() + timeout
+
+        if self._encoding:
+            yield from asyncio.wait(self._encoding, timeout=timeout,
+                                    loop=loop)
+
+        self._encode_executor.shutdown(wait=False)
+
+        if timeout is not None:
+            timeout = max(0, deadline - loop.time())
+
+        yield from transport.close(timeout=timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m raven_aiohttp',
+        description='Relay events of RelayTransport instances to Sentry.')
+    parser.add_argument('socket', help='unix socket to listen on')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--qsize', type=int, default=10000)
+    parser.add_argument('--max-pending', type=int, default=10000)
+    parser.add_argument('--close-timeout', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+
+    loop = asyncio.get_event_loop()
+
+    transport = QueuedAioHttpTransport(
+        workers=args.workers, max_workers=args.max_workers, qsize=args.qsize,
+        loop=loop)
+
+    server = RelayServer(args.socket, transport=transport,
+                         max_pending=args.max_pending, loop=loop)
+    loop.run_until_complete(server.start())
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(server.close(timeout=args.close_timeout))
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -42,7 +42,9 @@ tests_require = [
 
 install_requires = [
     'aiohttp>=2.0',
+    'multidict',  # installed with aiohttp
     'raven>=5.4.0',
+    'yarl',  # installed with aiohttp
 ]
 
 
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import socket
 from collections import defaultdict
 
@@ -9,9 +10,8 @@ from aiohttp.test_utils import unused_port
 class FakeResolver:
 
     _LOCAL_HOST = {
-        0: '127.0.0.1',
-        socket.AF_INET: '127.0.0.1',
         socket.AF_INET6: '::1',
+        socket.AF_INET: '127.0.0.1',
     }
 
     def __init__(self, port):
@@ -19,6 +19,12 @@ class FakeResolver:
 
     @asyncio.coroutine
     def resolve(self, host, port=0, family=socket.AF_INET):
+        # like getaddrinfo(), AF_UNSPEC gives addresses of both families
+        if family == socket.AF_UNSPEC:
+            families = [socket.AF_INET6, socket.AF_INET]
+        else:
+            families = [family]
+
         return [
             {
                 'hostname': host,
@@ -27,9 +33,14 @@ class FakeResolver:
                 'family': family,
                 'proto': 0,
                 'flags': socket.AI_NUMERICHOST,
-            },
+            }
+            for family in families
         ]
 
+    @asyncio.coroutine
+    def close(self):
+        pass
+
 
 class FakeServer:
 
@@ -39,9 +50,12 @@ class FakeServer:
 
     host = '127.0.0.1'
 
-    def __init__(self, *, side_effect=None, loop):
+    def __init__(self, *, side_effect=None, host=None, loop):
         self.loop = loop
 
+        if host is not None:
+            self.host = host
+
         if side_effect is None:
             side_effect = {
                 'status': 200,
@@ -56,6 +70,7 @@ class FakeServer:
         self.port = unused_port()
 
         self.hits = defaultdict(lambda: 0)
+        self.envelope_items = 0
 
     @property
     def side_effect(self):
@@ -80,13 +95,38 @@ class FakeServer:
 
     def setup_routes(self):
         self.app.router.add_post('/api/1/store/', self.store)
+        self.app.router.add_post('/api/1/envelope/', self.envelope)
 
     @asyncio.coroutine
     def store(self, request):
         yield from asyncio.sleep(self.slop_factor, loop=self.loop)
 
-        self.hits[self.side_effect['status']] += 1
-        return web.Response(**self.side_effect)
+        return self.respond(request)
+
+    @asyncio.coroutine
+    def envelope(self, request):
+        body = yield from request.read()
+
+        yield from asyncio.sleep(self.slop_factor, loop=self.loop)
+
+        _, body = body.split(b'\n', 1)
+
+        while body:
+            header, body = body.split(b'\n', 1)
+            length = json.loads(header.decode('utf-8'))['length']
+            body = body[length + 1:]
+
+            self.envelope_items += 1
+
+        return self.respond(request)
+
+    def respond(self, request):
+        side_effect = self.side_effect
+        if callable(side_effect):
+            side_effect = side_effect(request)
+
+        self.hits[side_effect['status']] += 1
+        return web.Response(**side_effect)
 
     @asyncio.coroutine
     def close(self):
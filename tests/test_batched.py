@@ -0,0 +1,124 @@
+import asyncio
+from functools import partial
+from unittest import mock
+
+import pytest
+from raven.exceptions import APIError
+
+from raven_aiohttp import BatchedAioHttpTransport
+
+pytestmark = pytest.mark.asyncio
+
+
+def send_events(client, transport, count):
+    """Enqueue ``count`` distinct events, returns their callbacks."""
+    url = client.remote.store_endpoint
+    headers = {'Content-Encoding': 'deflate'}
+    callbacks = [mock.Mock() for _ in range(count)]
+
+    for i, callback in enumerate(callbacks):
+        data = client.encode({'message': str(i)})
+        transport.async_send(url, data, headers, callback.success,
+                             callback.failure)
+
+    return callbacks
+
+
+def batched(server, **kwargs):
+    """A transport posting whole batches to the fake server."""
+    url = 'http://127.0.0.1:{}/api/1/envelope/'.format(server.port)
+
+    return partial(BatchedAioHttpTransport, envelope_url=url, **kwargs)
+
+
+@asyncio.coroutine
+def test_basic(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, batched(server))
+
+    send_events(client, transport, 10)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 1
+    assert server.envelope_items == 10
+
+
+@asyncio.coroutine
+def test_single_event_envelopes(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, BatchedAioHttpTransport)
+
+    callbacks = send_events(client, transport, 3)
+
+    yield from wait(transport)
+
+    # Sentry accepts a single event per envelope
+    assert server.hits[200] == 3
+    assert server.envelope_items == 3
+
+    for callback in callbacks:
+        assert callback.success.call_count == 1
+
+
+@asyncio.coroutine
+def test_batch_size(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, batched(server, batch_size=3))
+
+    send_events(client, transport, 7)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 3
+    assert server.envelope_items == 7
+
+
+@asyncio.coroutine
+def test_callbacks(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, batched(server))
+
+    callbacks = send_events(client, transport, 3)
+
+    yield from wait(transport)
+
+    for callback in callbacks:
+        assert callback.success.call_count == 1
+        assert not callback.failure.called
+
+
+@asyncio.coroutine
+def test_status_500(fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 500
+
+    client, transport = raven_client(server, batched(server))
+
+    callbacks = send_events(client, transport, 3)
+
+    yield from wait(transport)
+
+    assert server.hits[500] == 1
+
+    for callback in callbacks:
+        exc, = callback.failure.call_args[0]
+        assert isinstance(exc, APIError)
+        assert exc.code == 500
+
+
+@asyncio.coroutine
+def test_close_drains(fake_server, raven_client):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, batched(server))
+
+    send_events(client, transport, 5)
+
+    yield from transport.close()
+
+    assert server.envelope_items == 5
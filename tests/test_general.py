@@ -1,8 +1,17 @@
 import asyncio
+import json
+import logging
+import os
+import time
+import zlib
 
 import pytest
+from raven.exceptions import APIError, RateLimited
 
-from raven_aiohttp import AioHttpTransport, QueuedAioHttpTransport
+from raven_aiohttp import (AioHttpTransport, CircuitBreaker, Deduplicator,
+                           Instrumentation, QueuedAioHttpTransport,
+                           RetryPolicy, TokenBucket, TransportStats,
+                           event_level_priority, trim_event)
 
 transports = [QueuedAioHttpTransport, AioHttpTransport]
 
@@ -50,3 +59,267 @@ def test_transport_closed_twice(transport, event_loop, mocker):
     event_loop.run_until_complete(_transport.close())
 
     assert _transport._close_coro.call_count == 0
+
+
+def test_retry_policy_delay():
+    policy = RetryPolicy(base_delay=1, max_delay=5)
+
+    for attempt in range(1, 10):
+        delay = policy.get_delay(attempt)
+        assert 0 <= delay <= min(5, 2 ** (attempt - 1))
+
+
+def test_retry_policy_is_retryable():
+    policy = RetryPolicy()
+
+    assert policy.is_retryable(APIError(None, 503))
+    assert policy.is_retryable(asyncio.TimeoutError())
+    assert not policy.is_retryable(APIError(None, 400))
+    assert not policy.is_retryable(RateLimited(None, 10))
+    assert not policy.is_retryable(ValueError())
+
+
+def test_autoscale_bounds(event_loop):
+    with pytest.raises(ValueError):
+        QueuedAioHttpTransport(workers=2, max_workers=1, loop=event_loop)
+
+
+def test_event_level_priority():
+    headers = {'Content-Encoding': 'deflate'}
+
+    def encode(data):
+        return zlib.compress(json.dumps(data).encode('utf-8'))
+
+    fatal = event_level_priority(encode({'level': 'fatal'}), headers)
+    debug = event_level_priority(encode({'level': 'debug'}), headers)
+    error = event_level_priority(encode({}), headers)
+    numeric = event_level_priority(encode({'level': logging.WARNING}), headers)
+
+    assert fatal > error > numeric > debug
+
+
+def test_deduplicator():
+    headers = {'Content-Encoding': 'deflate'}
+
+    def encode(data):
+        return zlib.compress(json.dumps(data).encode('utf-8'))
+
+    reports = []
+    dedup = Deduplicator(window=10, maxsize=2, report=reports.append)
+
+    foo = encode({'message': 'foo', 'event_id': '1'})
+    foo_again = encode({'message': 'foo', 'event_id': '2'})
+    bar = encode({'message': 'bar'})
+    baz = encode({'message': 'baz'})
+
+    assert dedup.forward(foo, headers, 0)
+    assert not dedup.forward(foo_again, headers, 1)
+    assert not dedup.forward(foo_again, headers, 2)
+    assert dedup.forward(bar, headers, 3)
+    assert dedup.suppressed == 2
+
+    # bounded: the oldest fingerprint is evicted
+    assert dedup.forward(baz, headers, 4)
+    assert len(dedup) == 2
+
+    # the window is over, foo is forwarded again
+    assert dedup.forward(foo, headers, 11)
+
+    # foo was seen again at 11, it expires at 21
+    summary = dedup.purge(21)
+    assert list(summary.values()) == [2]
+    assert reports == [summary]
+    assert len(dedup) == 0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=2)
+
+    assert bucket.try_acquire(0)
+    assert bucket.try_acquire(0)
+    assert not bucket.try_acquire(0)
+    assert bucket.rejected == 1
+
+    assert bucket.try_acquire(0.5)
+    assert not bucket.try_acquire(0.5)
+
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(10) == 0.5
+    assert bucket.reserve(10) == 1
+    assert bucket.waited == 1.5
+
+
+def test_circuit_breaker():
+    changes = []
+    breaker = CircuitBreaker(failures=2, reset_timeout=10,
+                             on_change=lambda *args: changes.append(args))
+
+    assert breaker.allow(0)
+    breaker.failure(0)
+    breaker.success()
+    breaker.failure(1)
+    assert breaker.state == 'closed'
+
+    breaker.failure(2)
+    assert breaker.state == 'open'
+    assert not breaker.allow(5)
+    assert breaker.rejected == 1
+
+    # probe fails, the circuit opens again
+    assert breaker.allow(12)
+    assert breaker.state == 'half_open'
+    breaker.failure(13)
+    assert not breaker.allow(20)
+
+    # another probe is let through if the previous one hangs
+    assert breaker.allow(23)
+    assert not breaker.allow(24)
+    assert breaker.allow(33)
+    breaker.success()
+    assert breaker.allow(34)
+
+    assert changes == [
+        ('closed', 'open'),
+        ('open', 'half_open'),
+        ('half_open', 'open'),
+        ('open', 'half_open'),
+        ('half_open', 'closed'),
+    ]
+
+
+def test_trim_event():
+    headers = {'Content-Encoding': 'deflate'}
+
+    def encode(data):
+        return zlib.compress(json.dumps(data).encode('utf-8'))
+
+    def decode(data):
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    def blob():
+        return os.urandom(256).hex()
+
+    frame = {'function': 'foo', 'vars': {'local': blob()},
+             'pre_context': ['a'], 'post_context': ['b']}
+    event = {
+        'message': 'foo',
+        'exception': {'values': [{'stacktrace': {'frames': [frame]}}]},
+        'breadcrumbs': {'values': [{'message': blob()} for _ in range(20)]},
+        'extra': {'blob': blob()},
+    }
+    data = encode(event)
+
+    # locals are trimmed first
+    trimmed = decode(trim_event(data, headers, len(data) - 256))
+    frame, = trimmed['exception']['values'][0]['stacktrace']['frames']
+    assert 'vars' not in frame
+    assert len(trimmed['breadcrumbs']['values']) == 20
+
+    # then the oldest breadcrumbs
+    trimmed = decode(trim_event(data, headers, len(data) * 3 // 4))
+    assert trimmed['breadcrumbs']['values'] == \
+        event['breadcrumbs']['values'][-10:]
+    assert trimmed['extra'] == event['extra']
+
+    # everything optional is gone, the result is still too large
+    data = trim_event(data, headers, 1)
+    assert decode(data) == {
+        'message': 'foo',
+        'exception': {'values': [{'stacktrace': {'frames': [
+            {'function': 'foo'}]}}]},
+        'breadcrumbs': {'values': []},
+    }
+
+    # nothing to trim, returned unchanged
+    assert trim_event(data, headers, 1) == data
+
+
+def test_transport_stats():
+    stats = TransportStats(buckets=(0.1, 1), gauges={'depth': lambda: 3})
+
+    stats.requests += 2
+    stats.observe_latency(0.05)
+    stats.observe_latency(0.1)
+    stats.observe_latency(5)
+
+    snapshot = stats.snapshot()
+
+    assert snapshot['requests'] == 2
+    assert snapshot['depth'] == 3
+    assert snapshot['latency'] == {
+        'buckets': (0.1, 1),
+        'counts': [2, 0, 1],
+        'sum': 5.15,
+    }
+
+    # snapshots are not affected by later updates
+    stats.observe_latency(0.5)
+    assert snapshot['latency']['counts'] == [2, 0, 1]
+
+
+def test_instrumentation(event_loop):
+    stalls = []
+    instrumentation = Instrumentation(
+        lag_interval=0.01, lag_threshold=0.05,
+        on_stall=lambda *args: stalls.append(args))
+
+    @asyncio.coroutine
+    def step():
+        yield
+
+    @asyncio.coroutine
+    def send():
+        yield from step()
+        yield from step()
+        return 'sent'
+
+    callback = instrumentation.timed('callback', lambda value: value * 2)
+    assert callback(2) == 4
+
+    coro = instrumentation.timed_steps('send', send())
+    assert event_loop.run_until_complete(coro) == 'sent'
+
+    assert instrumentation.counts == {
+        'async_send': 0, 'callback': 1, 'send': 1}
+
+    instrumentation.start(event_loop)
+    event_loop.call_later(0.02, time.sleep, 0.1)
+    event_loop.run_until_complete(asyncio.sleep(0.2, loop=event_loop))
+    instrumentation.stop()
+
+    # the check may fall due up to lag_interval after the stall began
+    assert instrumentation.stalls == 1
+    assert instrumentation.max_lag >= 0.09
+    (lag, transport_time), = stalls
+    assert lag == instrumentation.max_lag
+
+
+def test_request_template(event_loop):
+    transport = AioHttpTransport(loop=event_loop)
+
+    url = 'https://sentry.example.com/api/1/store/'
+    headers = {'Content-Encoding': 'deflate', 'X-Sentry-Auth': 'first'}
+
+    first_url, first = transport._prepare_request(url, headers)
+    second_url, second = transport._prepare_request(
+        url, dict(headers, **{'X-Sentry-Auth': 'second'}))
+
+    # the parsed url is reused, only the auth header differs
+    assert second_url is first_url
+    assert str(first_url) == url
+    assert first['X-Sentry-Auth'] == 'first'
+    assert second['X-Sentry-Auth'] == 'second'
+    assert second['Content-Encoding'] == 'deflate'
+
+    # other static headers replace the template
+    _, third = transport._prepare_request(url, {'X-Sentry-Auth': 'third'})
+    assert 'Content-Encoding' not in third
+    assert len(transport._templates) == 1
+
+    event_loop.run_until_complete(transport.close())
+
+
+def test_overflow_policy_validation():
+    with pytest.raises(ValueError):
+        AioHttpTransport(overflow='block')
@@ -1,11 +1,13 @@
 import asyncio
 import logging
+import threading
 from functools import partial
 from unittest import mock
 
 import pytest
 
-from raven_aiohttp import QueuedAioHttpTransport
+from raven_aiohttp import (QueuedAioHttpTransport, RetryPolicy, TokenBucket,
+                           event_level_priority)
 from tests.utils import Logger
 
 pytestmark = pytest.mark.asyncio
@@ -29,33 +31,52 @@ def test_basic(fake_server, raven_client, wait):
 
 @asyncio.coroutine
 def test_no_keepalive(fake_server, raven_client, wait):
-    transport = QueuedAioHttpTransport(keepalive=False)
-    assert not hasattr(transport, '_client_session')
+    server = yield from fake_server()
+
+    transport = partial(QueuedAioHttpTransport, keepalive=False)
+    client, transport = raven_client(server, transport)
+
+    sessions = set()
+    for i in range(2):
+        # raven skips exceptions whose ids it has seen already
+        client.captureMessage('message {}'.format(i))
+
+        yield from wait(transport)
+
+        sessions.add(transport._client_session)
+
+    session, = sessions
+    assert session.connector.force_close
+    assert not session.closed
+
+    assert server.hits[200] == 2
+
     yield from transport.close()
 
-    server = yield from fake_server()
+    assert session.closed
 
-    client, transport = raven_client(server, QueuedAioHttpTransport)
-    transport._keepalive = False
-    session = transport._client_session
 
-    def _client_session_factory():
-        return session
+@asyncio.coroutine
+def test_connection_pool(fake_server, raven_client, wait):
+    server = yield from fake_server()
 
-    with mock.patch(
-        'raven_aiohttp.QueuedAioHttpTransport._client_session_factory',
-        side_effect=_client_session_factory,
-    ):
-        try:
-            1 / 0
-        except ZeroDivisionError:
-            client.captureException()
+    transport = partial(QueuedAioHttpTransport, limit=10, limit_per_host=5,
+                        keepalive_timeout=5)
+    client, transport = raven_client(server, transport)
 
-        yield from wait(transport)
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException()
+
+    yield from wait(transport)
 
-        assert session.closed
+    assert server.hits[200] == 1
 
-        assert server.hits[200] == 1
+    connector = transport._client_session.connector
+    assert connector.limit == 10
+    assert connector.limit_per_host == 5
+    assert not connector.force_close
 
 
 @asyncio.coroutine
@@ -189,7 +210,7 @@ def test_async_send_when_closed(fake_server, raven_client):
 def test_async_send_queue_full(fake_server, raven_client, wait):
     server = yield from fake_server()
 
-    with Logger('sentry.errors', level=logging.ERROR) as log:
+    with Logger('sentry.errors', level=logging.WARNING) as log:
         transport = partial(QueuedAioHttpTransport, qsize=1)
 
         client, transport = raven_client(server, transport)
@@ -207,17 +228,24 @@ def test_async_send_queue_full(fake_server, raven_client, wait):
         yield from wait(transport)
 
         assert server.hits[200] == 1
+        assert transport.stats.dropped == 1
 
-    msg = 'Sentry responded with an error: ' \
-          'QueuedAioHttpTransport internal queue is full'
-    assert log.msgs[0].startswith(msg)
+        # drops are reported as a summary instead of one error each
+        assert log.msgs == []
+
+        yield from transport.close()
+
+    assert log.msgs == [
+        'Dropped 1 messages: QueuedAioHttpTransport internal queue is full '
+        '(policy: drop_oldest)'
+    ]
 
 
 @asyncio.coroutine
 def test_async_send_queue_full_close(fake_server, raven_client):
     server = yield from fake_server()
 
-    with Logger('sentry.errors', level=logging.ERROR) as log:
+    with Logger('sentry.errors', level=logging.WARNING) as log:
         transport = partial(QueuedAioHttpTransport, qsize=1)
 
         client, transport = raven_client(server, transport)
@@ -231,6 +259,585 @@ def test_async_send_queue_full_close(fake_server, raven_client):
 
         assert server.hits[200] == 0
 
-    msg = 'Sentry responded with an error: ' \
-          'QueuedAioHttpTransport internal queue was full'
-    assert log.msgs[0].startswith(msg)
+    assert log.msgs == [
+        'Dropped 1 messages: QueuedAioHttpTransport internal queue was full '
+        '(policy: drop_oldest)'
+    ]
+
+
+@asyncio.coroutine
+def test_rate_limit_window_holds(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 429
+    server.side_effect['headers'] = {'Retry-After': '1'}
+
+    client, transport = raven_client(server, QueuedAioHttpTransport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+
+    assert transport.rate_limited
+
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from asyncio.sleep(0.5, loop=event_loop)
+
+    assert server.hits[429] == 1
+
+    yield from wait(transport, timeout=2)
+
+    assert server.hits[429] == 2
+    assert transport.rate_limit_stats == {'held': 1, 'dropped': 0}
+
+
+@asyncio.coroutine
+def test_retry_status_503(fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 503
+
+    with Logger('sentry.errors', level=logging.ERROR) as log:
+        retry_policy = RetryPolicy(attempts=3, base_delay=0)
+        transport = partial(QueuedAioHttpTransport, retry_policy=retry_policy)
+
+        client, transport = raven_client(server, transport)
+
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            client.captureException()
+
+        yield from wait(transport)
+
+        assert server.hits[503] == 3
+
+    msg = 'Sentry responded with an API error: APIError(None)'
+    assert log.msgs.count(msg) == 1
+
+
+@asyncio.coroutine
+def test_retry_then_success(fake_server, raven_client, wait):
+    statuses = iter([502, 200])
+
+    def side_effect(request):
+        return {'status': next(statuses)}
+
+    server = yield from fake_server(side_effect=side_effect)
+
+    with Logger('sentry.errors', level=logging.ERROR) as log:
+        retry_policy = RetryPolicy(attempts=3, base_delay=0)
+        transport = partial(QueuedAioHttpTransport, retry_policy=retry_policy)
+
+        client, transport = raven_client(server, transport)
+
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            client.captureException()
+
+        yield from wait(transport)
+
+        assert server.hits[502] == 1
+        assert server.hits[200] == 1
+
+    assert log.msgs == []
+
+
+@asyncio.coroutine
+def test_retry_not_for_client_errors(fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 400
+
+    retry_policy = RetryPolicy(attempts=3, base_delay=0)
+    transport = partial(QueuedAioHttpTransport, retry_policy=retry_policy)
+
+    client, transport = raven_client(server, transport)
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException()
+
+    yield from wait(transport)
+
+    assert server.hits[400] == 1
+
+
+@asyncio.coroutine
+def test_autoscale(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.slop_factor = 0.05
+
+    transport = partial(QueuedAioHttpTransport, workers=1, max_workers=4,
+                        scale_up_depth=1, idle_timeout=0.1)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    for _ in range(10):
+        transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+    assert transport.worker_count == 4
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 10
+
+    yield from asyncio.sleep(0.3, loop=event_loop)
+
+    assert transport.worker_count == 1
+    assert len(transport._workers) == 1
+
+
+@asyncio.coroutine
+def test_autoscale_close(fake_server, raven_client):
+    server = yield from fake_server()
+    server.slop_factor = 0.05
+
+    transport = partial(QueuedAioHttpTransport, workers=1, max_workers=3,
+                        scale_up_depth=1)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    for _ in range(6):
+        transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+    yield from transport.close()
+
+    assert server.hits[200] == 6
+    assert transport.worker_count == 0
+
+
+@asyncio.coroutine
+def test_priority_order(fake_server, raven_client, wait):
+    order = []
+
+    def side_effect(request):
+        order.append(request.headers['X-Name'])
+        return {'status': 200}
+
+    server = yield from fake_server(side_effect=side_effect)
+
+    client, transport = raven_client(server, QueuedAioHttpTransport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    for name, priority in [('a', 10), ('b', 40), ('c', 10), ('d', 50)]:
+        transport.async_send(url, data, {'X-Name': name}, mock.Mock(),
+                             mock.Mock(), priority=priority)
+
+    yield from wait(transport)
+
+    assert order == ['d', 'b', 'a', 'c']
+
+
+@asyncio.coroutine
+def test_priority_shed_lowest(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    reports = []
+    transport = partial(QueuedAioHttpTransport, qsize=2,
+                        drop_report=reports.append)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callbacks = {}
+    for name, priority in [('a', 10), ('b', 40), ('c', 50), ('d', 5)]:
+        callback = callbacks[name] = mock.Mock()
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure, priority=priority)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 2
+
+    for name in 'ad':
+        assert not callbacks[name].success.called
+        assert not callbacks[name].failure.called
+
+    for name in 'bc':
+        assert callbacks[name].success.called
+        assert not callbacks[name].failure.called
+
+
+@asyncio.coroutine
+def test_priority_event_level(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(QueuedAioHttpTransport, qsize=1,
+                        priority=event_level_priority)
+    client, transport = raven_client(server, transport)
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException(level='fatal')
+
+    client.captureMessage('debug message', level='debug')
+
+    # the debug message is the one dropped
+    assert [message.priority for message in transport._queue._queue] == \
+        [logging.CRITICAL]
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 1
+    assert transport.stats.dropped == 1
+
+
+@asyncio.coroutine
+def test_throttle_delays(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    throttle = TokenBucket(rate=20, burst=1)
+    transport = partial(QueuedAioHttpTransport, throttle=throttle)
+
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    for _ in range(3):
+        transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 3
+    assert throttle.rejected == 0
+    assert throttle.waited > 0
+
+
+@asyncio.coroutine
+def test_stats(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(QueuedAioHttpTransport, qsize=1)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    for _ in range(2):
+        transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+    assert transport.stats.snapshot()['queue_depth'] == 1
+
+    yield from wait(transport)
+
+    server.side_effect['status'] = 500
+    transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+    yield from wait(transport)
+
+    snapshot = transport.stats.snapshot()
+
+    assert snapshot['requests'] == 2
+    assert snapshot['succeeded'] == 1
+    assert snapshot['failed'] == 1
+    assert snapshot['status_5xx'] == 1
+    assert snapshot['dropped'] == 1
+    assert snapshot['in_flight'] == 0
+    assert snapshot['queue_depth'] == 0
+    assert snapshot['workers'] == 1
+    assert sum(snapshot['latency']['counts']) == 2
+
+
+@asyncio.coroutine
+def test_flush_cancel(fake_server, raven_client):
+    server = yield from fake_server()
+    server.slop_factor = 0.5
+
+    transport = partial(QueuedAioHttpTransport, workers=1)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(2):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    report = yield from transport.flush(timeout=0.01)
+    assert report == {'delivered': 0, 'failed': 0, 'spooled': 0,
+                      'pending': 2}
+
+    report = yield from transport.flush(timeout=0.01, cancel=True)
+    assert report == {'delivered': 0, 'failed': 2, 'spooled': 0,
+                      'pending': 0}
+    assert callback.failure.call_count == 2
+
+    # the transport keeps working after a cancelled flush
+    server.slop_factor = 0
+    assert transport.worker_count == 1
+
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    report = yield from transport.flush(timeout=1)
+    assert report == {'delivered': 1, 'failed': 0, 'spooled': 0,
+                      'pending': 0}
+    assert callback.success.call_count == 1
+
+
+@asyncio.coroutine
+def test_async_send_from_thread(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, QueuedAioHttpTransport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    foreign = []
+
+    def send():
+        foreign.append(transport._in_foreign_thread())
+
+        for _ in range(10):
+            transport.async_send(url, data, {}, callback.success,
+                                 callback.failure)
+
+    with mock.patch.object(event_loop, 'call_soon_threadsafe',
+                           wraps=event_loop.call_soon_threadsafe) as wakeup:
+        # the loop is blocked while the thread sends
+        thread = threading.Thread(target=send)
+        thread.start()
+        thread.join()
+
+        assert wakeup.call_count == 1
+
+    assert foreign == [True]
+    assert not transport._in_foreign_thread()
+
+    yield from asyncio.sleep(0, loop=event_loop)
+    yield from wait(transport)
+
+    assert server.hits[200] == 10
+    assert callback.success.call_count == 10
+
+
+@asyncio.coroutine
+def test_flush_from_thread(event_loop, fake_server, raven_client):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, QueuedAioHttpTransport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+
+    # the loop is blocked while the thread sends
+    thread = threading.Thread(target=lambda: transport.async_send(
+        url, data, {}, callback.success, callback.failure))
+    thread.start()
+    thread.join()
+
+    report = yield from transport.flush(timeout=1)
+
+    assert report == {'delivered': 1, 'failed': 0, 'spooled': 0,
+                      'pending': 0}
+    assert server.hits[200] == 1
+    assert callback.success.call_count == 1
+
+
+@asyncio.coroutine
+def test_overflow_drop_newest(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    reports = []
+    transport = partial(QueuedAioHttpTransport, qsize=2,
+                        overflow='drop_newest', drop_report=reports.append,
+                        drop_report_interval=0.01)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callbacks = {}
+    for name, priority in [('a', 10), ('b', 40), ('c', 50)]:
+        callback = callbacks[name] = mock.Mock()
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure, priority=priority)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 2
+    assert callbacks['a'].success.called
+    assert callbacks['b'].success.called
+    assert not callbacks['c'].success.called
+
+    yield from asyncio.sleep(0.02, loop=event_loop)
+
+    assert reports == [{
+        'QueuedAioHttpTransport internal queue is full '
+        '(policy: drop_newest)': 1
+    }]
+
+
+@asyncio.coroutine
+def test_overflow_block(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.slop_factor = 0.01
+
+    transport = partial(QueuedAioHttpTransport, qsize=1, overflow='block',
+                        block_timeout=1)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(3):
+        yield from transport.enqueue(url, data, {}, callback.success,
+                                     callback.failure)
+
+    # synchronous callers can not wait, the new message is dropped
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 3
+    assert callback.success.call_count == 3
+    assert transport.stats.dropped == 1
+
+    # one message in flight, one queued, the third one times out
+    server.slop_factor = 0.5
+    yield from transport.enqueue(url, data, {}, callback.success,
+                                 callback.failure)
+    yield from asyncio.sleep(0.01, loop=event_loop)
+
+    for _ in range(2):
+        yield from transport.enqueue(url, data, {}, callback.success,
+                                     callback.failure, timeout=0.01)
+
+    assert transport.stats.dropped == 2
+
+
+@asyncio.coroutine
+def test_overflow_sample(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(QueuedAioHttpTransport, qsize=100, overflow='sample',
+                        sample_threshold=0.5)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    with mock.patch('random.random', return_value=0.5):
+        for _ in range(100):
+            transport.async_send(url, data, {}, callback.success,
+                                 callback.failure)
+
+    # accepted while (100 - depth) / 50 > 0.5
+    assert transport._queue.qsize() == 75
+    assert transport.stats.dropped == 25
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 75
+
+
+@asyncio.coroutine
+def test_qbytes(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    reports = []
+    transport = partial(QueuedAioHttpTransport, qbytes=300,
+                        drop_report=reports.append)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+
+    callbacks = []
+    for size in [100, 100, 100, 150, 400]:
+        callback = mock.Mock()
+        callbacks.append(callback)
+        transport.async_send(url, b'x' * size, {}, callback.success,
+                             callback.failure)
+
+    # the 150 bytes message takes the room of the two oldest ones, the
+    # 400 bytes message never fits
+    assert transport.queued_bytes == 250
+    assert transport.stats.snapshot()['queue_bytes'] == 250
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 2
+    assert [callback.success.called for callback in callbacks] == \
+        [False, False, True, True, False]
+    assert transport.queued_bytes == 0
+
+    yield from transport.close()
+
+    assert reports == [{
+        'QueuedAioHttpTransport internal queue is full '
+        '(policy: drop_oldest)': 2,
+        'QueuedAioHttpTransport message exceeds the queue byte budget '
+        '(policy: drop_oldest)': 1,
+    }]
+
+
+@asyncio.coroutine
+def test_qbytes_shed_only_with_room(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(QueuedAioHttpTransport, qbytes=100)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+
+    callbacks = []
+    for size, priority in [(60, 10), (30, 0), (50, 5)]:
+        callback = mock.Mock()
+        callbacks.append(callback)
+        transport.async_send(url, b'x' * size, {}, callback.success,
+                             callback.failure, priority=priority)
+
+    # shedding the 30 bytes message would not make room, only the new
+    # message is dropped
+    assert transport.queued_bytes == 90
+    assert transport.stats.dropped == 1
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 2
+    assert [callback.success.called for callback in callbacks] == \
+        [True, True, False]
+
+
+@asyncio.coroutine
+def test_qbytes_block(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.slop_factor = 0.01
+
+    transport = partial(QueuedAioHttpTransport, qbytes=200, overflow='block')
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+
+    callback = mock.Mock()
+    for _ in range(4):
+        yield from transport.enqueue(url, b'x' * 150, {}, callback.success,
+                                     callback.failure)
+
+        assert transport.queued_bytes <= 200
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 4
+    assert transport.stats.dropped == 0
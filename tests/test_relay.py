@@ -0,0 +1,155 @@
+import asyncio
+import os
+import socket
+from unittest import mock
+
+import async_timeout
+import pytest
+
+from raven_aiohttp import QueuedAioHttpTransport, RelayServer, RelayTransport
+from tests.fake import FakeResolver
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def relay_server(event_loop, tmpdir):
+    servers = []
+
+    @asyncio.coroutine
+    def do_relay_server(fake_server, **kwargs):
+        transport = QueuedAioHttpTransport(
+            resolver=FakeResolver(fake_server.port), loop=event_loop)
+
+        path = str(tmpdir.join('relay.sock'))
+        server = RelayServer(path, transport=transport, loop=event_loop,
+                             **kwargs)
+        yield from server.start()
+
+        servers.append(server)
+
+        return server
+
+    yield do_relay_server
+
+    for server in servers:
+        event_loop.run_until_complete(server.close())
+
+
+@asyncio.coroutine
+def wait_relay(relay, count, loop, timeout=2):
+    with async_timeout.timeout(timeout, loop=loop):
+        while relay.delivered + relay.failed < count:
+            yield from asyncio.sleep(0.01, loop=loop)
+
+
+@asyncio.coroutine
+def test_relay(event_loop, fake_server, raven_client, relay_server, wait):
+    server = yield from fake_server()
+    relay = yield from relay_server(server)
+
+    client, transport = raven_client(server, RelayTransport, path=relay.path)
+
+    url = client.remote.store_endpoint
+    headers = {'Content-Encoding': 'deflate'}
+
+    for i in range(3):
+        data = client.encode({'message': str(i)})
+        transport.async_send(url, data, headers, mock.Mock(), mock.Mock())
+
+    yield from wait(transport)
+    yield from wait_relay(relay, 3, event_loop)
+
+    assert transport.stats.succeeded == 3
+    assert relay.received == 3
+    assert relay.delivered == 3
+    assert server.hits[200] == 3
+
+
+@asyncio.coroutine
+def test_relay_backpressure(event_loop, fake_server, raven_client,
+                            relay_server, wait):
+    server = yield from fake_server()
+    server.slop_factor = 0.05
+
+    relay = yield from relay_server(server, max_pending=1)
+
+    client, transport = raven_client(server, RelayTransport, path=relay.path)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(3):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    yield from wait(transport)
+    yield from wait_relay(relay, 3, event_loop)
+
+    assert relay.held >= 1
+    assert relay.delivered == 3
+    assert server.hits[200] == 3
+    assert relay.transport._flush_waiters == []
+
+
+@asyncio.coroutine
+def test_relay_stale_socket(event_loop, tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+
+    # left behind by a relay which is gone
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(path)
+    sock.close()
+
+    relay = RelayServer(path, loop=event_loop)
+    yield from relay.start()
+
+    assert (yield from relay._in_use())
+
+    yield from relay.close()
+
+
+@asyncio.coroutine
+def test_relay_path_in_use(event_loop, tmpdir, fake_server, relay_server):
+    server = yield from fake_server()
+    relay = yield from relay_server(server)
+
+    other = RelayServer(relay.path, loop=event_loop)
+    with pytest.raises(OSError):
+        yield from other.start()
+
+    assert os.path.exists(relay.path)
+
+    path = str(tmpdir.join('file'))
+    with open(path, 'w') as f:
+        f.write('not a socket')
+
+    other = RelayServer(path, loop=event_loop)
+    with pytest.raises(OSError):
+        yield from other.start()
+
+    with open(path) as f:
+        assert f.read() == 'not a socket'
+
+    yield from other.transport.close()
+
+
+@asyncio.coroutine
+def test_relay_unavailable(tmpdir, fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    path = str(tmpdir.join('missing.sock'))
+    client, transport = raven_client(server, RelayTransport, path=path)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+
+    exc, = callback.failure.call_args[0]
+    assert isinstance(exc, OSError)
+    assert transport.stats.errors == 1
@@ -0,0 +1,191 @@
+import asyncio
+import os
+from functools import partial
+from unittest import mock
+
+import async_timeout
+import pytest
+
+from raven_aiohttp import AioHttpTransport, QueuedAioHttpTransport, Spool
+
+
+def test_write_read(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=100, chunk_size=64)
+
+    records = [
+        ('http://example.com/{}'.format(i), {'X-Index': str(i)}, b'x' * i * 10)
+        for i in range(10)
+    ]
+    spool.write(records[:5])
+    spool.write(records[5:])
+
+    assert spool.written == 10
+
+    segments = spool.seal()
+    assert len(segments) > 1
+
+    result = []
+    for segment in segments:
+        offset = 0
+        while True:
+            chunk = spool.read(segment, offset)
+            if not chunk:
+                break
+
+            offset = chunk[-1][0]
+            result.extend(tuple(record) for _, record in chunk)
+
+    assert result == records
+
+    for segment in segments:
+        spool.remove(segment)
+
+    assert spool.size == 0
+    assert os.listdir(str(tmpdir)) == []
+
+    spool.close()
+
+
+def test_max_size(tmpdir):
+    spool = Spool(str(tmpdir), segment_size=100, max_size=300)
+
+    spool.write([('url', {}, b'x' * 60) for _ in range(20)])
+
+    assert spool.size <= 300
+    assert spool.written == 20
+
+    spool.close()
+
+
+def test_permissions(tmpdir):
+    path = str(tmpdir.join('spool'))
+    spool = Spool(path)
+
+    # records hold the X-Sentry-Auth header
+    spool.write([('url', {'X-Sentry-Auth': 'Sentry sentry_key=public'},
+                  b'x')])
+    segment, = spool.seal()
+
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert os.stat(segment).st_mode & 0o777 == 0o600
+
+    spool.close()
+
+
+def test_reopen_and_torn_record(tmpdir):
+    spool = Spool(str(tmpdir))
+    spool.write([('url', {}, b'data')])
+    segment, = spool.seal()
+    spool.close()
+
+    with open(segment, 'ab') as f:
+        f.write(b'\x00\x00\x00\x10')
+
+    spool = Spool(str(tmpdir))
+    assert spool.size == os.path.getsize(segment)
+
+    (_, record), = spool.read(segment, 0)
+    assert tuple(record) == ('url', {}, b'data')
+
+    spool.write([('url', {}, b'more')])
+    assert len(spool.seal()) == 2
+
+    spool.close()
+
+
+@asyncio.coroutine
+def wait_spool(transport, loop, timeout=2):
+    with async_timeout.timeout(timeout, loop=loop):
+        while transport._spool_writing is not None or \
+                transport._spool_replay is not None:
+            yield from asyncio.sleep(0.01, loop=loop)
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_unreachable_and_replay(event_loop, tmpdir, fake_server,
+                                raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 503
+
+    spool = Spool(str(tmpdir))
+    transport = partial(QueuedAioHttpTransport, spool=spool)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(3):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    yield from wait(transport)
+    yield from wait_spool(transport, event_loop)
+
+    assert server.hits[503] == 3
+    assert not callback.failure.called
+    assert spool.written == 3
+
+    server.side_effect['status'] = 200
+
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+    yield from wait_spool(transport, event_loop)
+
+    assert server.hits[200] == 4
+    assert spool.replayed == 3
+    assert spool.size == 0
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_queue_full(event_loop, tmpdir, fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    spool = Spool(str(tmpdir))
+    transport = partial(QueuedAioHttpTransport, qsize=1, spool=spool)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(3):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    assert not callback.failure.called
+
+    yield from wait(transport)
+    yield from wait_spool(transport, event_loop)
+
+    # the spooled messages are replayed after the first success
+    assert server.hits[200] == 3
+    assert spool.written == 2
+    assert spool.replayed == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('cls', [AioHttpTransport, QueuedAioHttpTransport])
+@asyncio.coroutine
+def test_close_timeout(cls, tmpdir, fake_server, raven_client):
+    server = yield from fake_server()
+    server.slop_factor = 100
+
+    spool = Spool(str(tmpdir))
+    client, transport = raven_client(server, partial(cls, spool=spool))
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    for _ in range(2):
+        transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+    yield from transport.close(timeout=0.1)
+
+    assert server.hits[200] == 0
+    assert spool.written == 2
+
+    assert Spool(str(tmpdir)).size == spool.size > 0
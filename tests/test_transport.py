@@ -1,10 +1,20 @@
 import asyncio
 import logging
+import os
+import socket
+import threading
+from functools import partial
 from unittest import mock
 
 import pytest
-
-from raven_aiohttp import AioHttpTransport
+from raven.exceptions import RateLimited
+
+from raven_aiohttp import (AioHttpTransport, CircuitBreaker, CircuitOpen,
+                           Deduplicator, HappyEyeballsResolver,
+                           Instrumentation, PayloadTooLarge,
+                           QueuedAioHttpTransport, RetryPolicy,
+                           SessionRegistry, TokenBucket, trim_event)
+from tests.fake import FakeResolver
 from tests.utils import Logger
 
 pytestmark = pytest.mark.asyncio
@@ -28,33 +38,94 @@ def test_basic(fake_server, raven_client, wait):
 
 @asyncio.coroutine
 def test_no_keepalive(fake_server, raven_client, wait):
-    transport = AioHttpTransport(keepalive=False)
-    assert not hasattr(transport, '_client_session')
+    server = yield from fake_server()
+
+    transport = partial(AioHttpTransport, keepalive=False)
+    client, transport = raven_client(server, transport)
+
+    sessions = set()
+    for i in range(2):
+        # raven skips exceptions whose ids it has seen already
+        client.captureMessage('message {}'.format(i))
+
+        yield from wait(transport)
+
+        sessions.add(transport._client_session)
+
+    session, = sessions
+    assert session.connector.force_close
+    assert not session.closed
+
+    assert server.hits[200] == 2
+
     yield from transport.close()
 
+    assert session.closed
+
+
+@asyncio.coroutine
+def test_connection_pool(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(AioHttpTransport, limit=10, limit_per_host=5,
+                        keepalive_timeout=5)
+    client, transport = raven_client(server, transport)
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException()
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 1
+
+    connector = transport._client_session.connector
+    assert connector.limit == 10
+    assert connector.limit_per_host == 5
+    assert not connector.force_close
+
+
+@asyncio.coroutine
+def test_session_per_process(fake_server, raven_client, wait):
     server = yield from fake_server()
 
     client, transport = raven_client(server, AioHttpTransport)
-    transport._keepalive = False
-    session = transport._client_session
 
-    def _client_session_factory():
-        return session
+    assert transport._client_session is None
 
-    with mock.patch(
-        'raven_aiohttp.AioHttpTransport._client_session_factory',
-        side_effect=_client_session_factory,
-    ):
-        try:
-            1 / 0
-        except ZeroDivisionError:
-            client.captureException()
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException()
+
+    yield from wait(transport)
 
+    parent = transport._client_session
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    with mock.patch('os.getpid', return_value=os.getpid() + 1):
+        # raven skips a second capture of an exception with the same id
+        transport.async_send(url, data, {}, mock.Mock(), mock.Mock())
+
+        # asyncio disowns a running loop of another pid, the send is
+        # handed over to the loop
+        yield from asyncio.sleep(0, loop=transport._loop)
         yield from wait(transport)
 
-        assert session.closed
+        child = transport._client_session
 
-        assert server.hits[200] == 1
+        yield from transport.close()
+
+    assert server.hits[200] == 2
+
+    assert child is not parent
+    assert child.closed
+    assert not parent.closed
+
+    yield from parent.close()
 
 
 @asyncio.coroutine
@@ -181,3 +252,564 @@ def test_async_send_when_closed(fake_server, raven_client):
         'Sentry responded with an error: AioHttpTransport is closed')
 
     yield from close
+
+
+@asyncio.coroutine
+def test_rate_limit_window_drops(fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 429
+    server.side_effect['headers'] = {'Retry-After': '10'}
+
+    client, transport = raven_client(server, AioHttpTransport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    first, second = mock.Mock(), mock.Mock()
+
+    transport.async_send(url, data, {}, first.success, first.failure)
+
+    yield from wait(transport)
+
+    assert transport.rate_limited
+
+    transport.async_send(url, data, {}, second.success, second.failure)
+
+    yield from wait(transport)
+
+    assert server.hits[429] == 1
+    assert transport.rate_limit_stats == {'held': 0, 'dropped': 1}
+
+    exc, = second.failure.call_args[0]
+    assert isinstance(exc, RateLimited)
+    assert exc.retry_after == 10
+    assert not second.success.called
+
+
+@asyncio.coroutine
+def test_retry_status_503(fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 503
+
+    with Logger('sentry.errors', level=logging.ERROR) as log:
+        retry_policy = RetryPolicy(attempts=3, base_delay=0)
+        transport = partial(AioHttpTransport, retry_policy=retry_policy)
+
+        client, transport = raven_client(server, transport)
+
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            client.captureException()
+
+        yield from wait(transport)
+
+        assert server.hits[503] == 3
+
+    msg = 'Sentry responded with an API error: APIError(None)'
+    assert log.msgs.count(msg) == 1
+
+
+@asyncio.coroutine
+def test_retry_then_success(fake_server, raven_client, wait):
+    statuses = iter([502, 200])
+
+    def side_effect(request):
+        return {'status': next(statuses)}
+
+    server = yield from fake_server(side_effect=side_effect)
+
+    with Logger('sentry.errors', level=logging.ERROR) as log:
+        retry_policy = RetryPolicy(attempts=3, base_delay=0)
+        transport = partial(AioHttpTransport, retry_policy=retry_policy)
+
+        client, transport = raven_client(server, transport)
+
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            client.captureException()
+
+        yield from wait(transport)
+
+        assert server.hits[502] == 1
+        assert server.hits[200] == 1
+
+    assert log.msgs == []
+
+
+@asyncio.coroutine
+def test_retry_not_for_client_errors(fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 400
+
+    retry_policy = RetryPolicy(attempts=3, base_delay=0)
+    transport = partial(AioHttpTransport, retry_policy=retry_policy)
+
+    client, transport = raven_client(server, transport)
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException()
+
+    yield from wait(transport)
+
+    assert server.hits[400] == 1
+
+
+@asyncio.coroutine
+def test_dedup(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    reports = []
+    dedup = Deduplicator(window=60, report=reports.append)
+    transport = partial(AioHttpTransport, dedup=dedup)
+
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    headers = {'Content-Encoding': 'deflate'}
+
+    for i in range(10):
+        # identical events apart from the event id
+        data = client.encode({'message': 'foo', 'event_id': str(i)})
+        transport.async_send(url, data, headers, mock.Mock(), mock.Mock())
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 1
+    assert dedup.suppressed == 9
+
+    yield from transport.close()
+
+    assert list(reports[0].values()) == [9]
+
+
+@asyncio.coroutine
+def test_throttle_drops(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    reports = []
+    throttle = TokenBucket(rate=1, burst=2)
+    transport = partial(AioHttpTransport, throttle=throttle,
+                        drop_report=reports.append, drop_report_interval=0.01)
+
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(5):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 2
+    assert callback.success.call_count == 2
+    # a client side drop must not make raven back off
+    assert not callback.failure.called
+    assert throttle.rejected == 3
+    assert transport.stats.dropped == 3
+
+    yield from asyncio.sleep(0.02, loop=event_loop)
+
+    assert reports == [{'AioHttpTransport outbound rate limit exceeded': 3}]
+
+
+@asyncio.coroutine
+def test_stats_callback(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    snapshots = []
+    transport = partial(AioHttpTransport, stats_callback=snapshots.append,
+                        stats_interval=0.01)
+    client, transport = raven_client(server, transport)
+
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        client.captureException()
+
+    yield from wait(transport)
+    yield from asyncio.sleep(0.05, loop=event_loop)
+    yield from transport.close()
+
+    assert len(snapshots) >= 2
+    assert snapshots[-1]['succeeded'] == 1
+    assert snapshots[-1]['tasks'] == 0
+
+
+@asyncio.coroutine
+def test_max_in_flight_drop_newest(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    reports = []
+    transport = partial(AioHttpTransport, max_in_flight=2,
+                        drop_report=reports.append)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(5):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 2
+    assert callback.success.call_count == 2
+    assert not callback.failure.called
+    assert transport.stats.dropped == 3
+
+    yield from transport.close()
+
+    assert reports == [{
+        'AioHttpTransport has too many sends in flight '
+        '(policy: drop_newest)': 3
+    }]
+
+
+@asyncio.coroutine
+def test_max_in_flight_drop_oldest(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(AioHttpTransport, max_in_flight=1,
+                        overflow='drop_oldest')
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    first, second = mock.Mock(), mock.Mock()
+    transport.async_send(url, data, {}, first.success, first.failure)
+    transport.async_send(url, data, {}, second.success, second.failure)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 1
+    assert not first.success.called
+    assert second.success.call_count == 1
+    assert transport.stats.dropped == 1
+
+
+@asyncio.coroutine
+def test_max_in_flight_buffer(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    transport = partial(AioHttpTransport, max_in_flight=1,
+                        overflow='buffer', buffer_size=2)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(4):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    assert len(transport._tasks) == 1
+    assert len(transport._buffer) == 2
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 3
+    assert callback.success.call_count == 3
+    assert transport.stats.dropped == 1
+
+
+@asyncio.coroutine
+def test_close_timeout_buffered(fake_server, raven_client):
+    server = yield from fake_server()
+    server.slop_factor = 100
+
+    transport = partial(AioHttpTransport, max_in_flight=1,
+                        overflow='buffer')
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(3):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+    yield from transport.close(timeout=0)
+
+    assert server.hits[200] == 0
+    assert callback.failure.call_count == 3
+    assert not transport._tasks
+    assert not transport._buffer
+
+
+@asyncio.coroutine
+def test_circuit_breaker(event_loop, fake_server, raven_client, wait):
+    server = yield from fake_server()
+    server.side_effect['status'] = 503
+
+    changes = []
+    breaker = CircuitBreaker(failures=2, reset_timeout=0.05,
+                             on_change=lambda *args: changes.append(args))
+    transport = partial(AioHttpTransport, circuit_breaker=breaker)
+    client, transport = raven_client(server, transport)
+
+    url = client.remote.store_endpoint
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    for _ in range(4):
+        transport.async_send(url, data, {}, callback.success,
+                             callback.failure)
+
+        yield from wait(transport)
+
+    assert server.hits[503] == 2
+    assert callback.failure.call_count == 4
+    assert isinstance(callback.failure.call_args[0][0], CircuitOpen)
+    assert transport.stats.snapshot()['circuit_state'] == 'open'
+
+    server.side_effect['status'] = 200
+    yield from asyncio.sleep(0.05, loop=event_loop)
+
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+
+    assert server.hits[200] == 1
+    assert callback.success.call_count == 1
+    assert changes == [
+        ('closed', 'open'),
+        ('open', 'half_open'),
+        ('half_open', 'closed'),
+    ]
+
+
+@asyncio.coroutine
+def test_flush(fake_server, raven_client):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, AioHttpTransport)
+
+    assert (yield from transport.flush()) == {
+        'delivered': 0, 'failed': 0, 'spooled': 0, 'pending': 0}
+
+    url = client.remote.store_endpoint
+    headers = {'Content-Encoding': 'deflate'}
+
+    for i in range(3):
+        data = client.encode({'message': str(i)})
+        transport.async_send(url, data, headers, mock.Mock(), mock.Mock())
+
+    report = yield from transport.flush(timeout=1)
+
+    assert report == {'delivered': 3, 'failed': 0, 'spooled': 0,
+                      'pending': 0}
+    assert server.hits[200] == 3
+
+
+@asyncio.coroutine
+def test_session_registry(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    registry = SessionRegistry()
+
+    clients = [
+        raven_client(server, cls, session_registry=registry)
+        for cls in (AioHttpTransport, QueuedAioHttpTransport)
+    ]
+
+    for client, transport in clients:
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            client.captureException()
+
+        yield from wait(transport)
+
+    assert server.hits[200] == 2
+    assert len(registry) == 1
+
+    (_, first), (_, second) = clients
+    session = first._client_session
+    assert second._client_session is session
+
+    yield from first.close()
+    assert not session.closed
+
+    yield from second.close()
+    assert session.closed
+    assert len(registry) == 0
+
+
+@asyncio.coroutine
+def test_max_payload_size(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, AioHttpTransport,
+                                     max_payload_size=2048)
+
+    url = client.remote.store_endpoint
+    # random data does not compress
+    data = client.encode({'message': 'foo',
+                          'extra': {'blob': os.urandom(4096).hex()}})
+
+    callback = mock.Mock()
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+
+    exc, = callback.failure.call_args[0]
+    assert isinstance(exc, PayloadTooLarge)
+    assert exc.size == len(data)
+    assert exc.limit == 2048
+    assert transport.stats.oversized == 1
+    assert transport.stats.requests == 0
+    assert server.hits[200] == 0
+
+
+@asyncio.coroutine
+def test_max_payload_size_trimmed(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, AioHttpTransport,
+                                     max_payload_size=2048,
+                                     trimmer=trim_event)
+
+    url = client.remote.store_endpoint
+    headers = {'Content-Encoding': 'deflate'}
+    data = client.encode({'message': 'foo',
+                          'extra': {'blob': os.urandom(4096).hex()}})
+
+    callback = mock.Mock()
+    transport.async_send(url, data, headers, callback.success,
+                         callback.failure)
+
+    yield from wait(transport)
+
+    assert callback.success.called
+    assert transport.stats.trimmed == 1
+    assert server.hits[200] == 1
+
+
+@asyncio.coroutine
+def test_instrumentation(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    instrumentation = Instrumentation()
+    client, transport = raven_client(server, AioHttpTransport,
+                                     instrumentation=instrumentation)
+
+    url = client.remote.store_endpoint
+    headers = {'Content-Encoding': 'deflate'}
+
+    for i in range(3):
+        data = client.encode({'message': str(i)})
+        transport.async_send(url, data, headers, mock.Mock(), mock.Mock())
+
+    yield from wait(transport)
+
+    assert instrumentation.counts == {
+        'async_send': 3, 'callback': 3, 'send': 3}
+    assert instrumentation.totals['send'] > 0
+    assert transport.stats.snapshot()['loop_stalls'] == 0
+
+    yield from transport.close()
+    assert instrumentation._handle is None
+
+
+@asyncio.coroutine
+def test_family_auto(fake_server, raven_client, wait):
+    server = yield from fake_server()
+
+    client, transport = raven_client(server, AioHttpTransport, family=None)
+
+    resolver = transport._connector_kwargs['resolver']
+    assert isinstance(resolver, HappyEyeballsResolver)
+    assert transport.family == socket.AF_UNSPEC
+
+    # IP addresses are not resolved
+    url = 'http://sentry.example.com/api/1/store/'
+    data = client.encode({'message': 'foo'})
+
+    callback = mock.Mock()
+    transport.async_send(url, data, {}, callback.success, callback.failure)
+
+    yield from wait(transport)
+
+    assert callback.success.called
+    assert server.hits[200] == 1
+
+    # nothing listens on ::1, IPv4 won the race
+    family, _ = resolver._winners['sentry.example.com', 80]
+    assert family == socket.AF_INET
+
+
+@pytest.mark.skipif(not socket.has_ipv6, reason='IPv6 is not supported')
+@asyncio.coroutine
+def test_happy_eyeballs_resolver(event_loop, fake_server):
+    server = yield from fake_server(host='::1')
+
+    resolver = HappyEyeballsResolver(FakeResolver(server.port), ttl=10,
+                                     loop=event_loop)
+    resolver._race = mock.Mock(wraps=resolver._race)
+
+    hosts = yield from resolver.resolve('sentry.example.com', 80)
+    families = [host['family'] for host in hosts]
+    assert families == [socket.AF_INET6, socket.AF_INET]
+
+    # the winner is remembered for ttl seconds
+    yield from resolver.resolve('sentry.example.com', 80)
+    assert resolver._race.call_count == 1
+
+    # a single family is passed through
+    hosts = yield from resolver.resolve('sentry.example.com', 80,
+                                        family=socket.AF_INET)
+    assert [host['family'] for host in hosts] == [socket.AF_INET]
+
+
+# without _get_running_loop (Python < 3.5.3) the loop records its thread
+@pytest.mark.parametrize('get_running_loop', [
+    getattr(asyncio, '_get_running_loop', None), None])
+@asyncio.coroutine
+def test_created_in_other_thread(event_loop, fake_server, get_running_loop):
+    server = yield from fake_server()
+
+    url = 'http://127.0.0.1:{}/api/1/store/'.format(server.port)
+    callback = mock.Mock()
+    transports = []
+
+    def send():
+        # raven creates its transport lazily, right before the first send
+        transport = AioHttpTransport(loop=event_loop,
+                                     resolver=FakeResolver(server.port))
+        transports.append(transport)
+
+        transport.async_send(url, b'{}', {}, callback.success,
+                             callback.failure)
+
+    with mock.patch('raven_aiohttp._get_running_loop', get_running_loop):
+        # the loop is blocked while the thread creates the transport
+        thread = threading.Thread(target=send)
+        thread.start()
+        thread.join()
+
+        transport, = transports
+
+        # the send is handed over to the loop instead of accepted in place
+        assert len(transport._handoff) == 1
+
+        yield from asyncio.sleep(0, loop=event_loop)
+        assert not transport._in_foreign_thread()
+
+        yield from transport.flush(timeout=1)
+
+        yield from transport.close()
+
+    assert server.hits[200] == 1
+    assert callback.success.call_count == 1